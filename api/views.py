@@ -1,6 +1,4 @@
 from django.http import HttpRequest
-from django.shortcuts import redirect
-from django.urls import reverse
 
 from fund.views import fund_rt_price
 
@@ -8,5 +6,5 @@ from fund.views import fund_rt_price
 
 
 def api_rt(request: HttpRequest, code: str = None):
-    print(1)
-    return redirect(reverse(fund_rt_price, args=[code]))
\ No newline at end of file
+    # served in place, a redirect costs API pollers an extra round trip
+    return fund_rt_price(request, code)
@@ -1,6 +1,7 @@
 from django.contrib import admin
-from .models import WatchFund
+from .models import FundHolding, WatchFund
 
 # Register your models here.
 
-admin.site.register(WatchFund)
\ No newline at end of file
+admin.site.register(WatchFund)
+admin.site.register(FundHolding)
\ No newline at end of file
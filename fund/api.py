@@ -1,13 +1,19 @@
-from typing import Any, Dict, List, Optional
-import akshare as ak
-from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+from dataclasses import dataclass, field, replace
 import logging
 import traceback
 import datetime
 import math
-import requests
-from bs4 import BeautifulSoup
+import threading
+import time
+import numpy as np
+import pandas as pd
+from django.conf import settings
 from django.core.cache import cache
+from .factors import FactorTable, get_mapped_factors, publish_factors
+from .market import MARKETS, disclose_delay, disclosed_quarter, next_disclosure, quarter_end, refresh_timeout, season_quarter
+from .models import FundHolding
+from .upstream import ak, call, get_text, source_of
 
 logger = logging.getLogger("root")
 
@@ -27,6 +33,8 @@ class Fund(object):
     _stock_share: float = 0
     _bond_share: float = 0
     bond: List[Dict[str, Any]] = field(default_factory=list)
+    # day each part was last fetched: "info" (basic information and ratings), "holdings" (holdings and allocation)
+    checked: Optional[Dict[str, datetime.date]] = None
 
     @property
     def star(self):
@@ -144,6 +152,10 @@ def get_fund(code: str):
             fund.scale = f["total_scale"]
             fund._stock_share = f["stock_share"]
             fund._bond_share = f["bond_share"]
+        today = datetime.date.today()
+        fund.checked = {"info": today}
+        if f or fund.stock or fund.bond:
+            fund.checked.update(holdings=today, quarter=disclosed_quarter(today))
     except Exception as e:
         traceback.print_exc()
         logger.error(f"get fund info error: {e}")
@@ -151,15 +163,121 @@ def get_fund(code: str):
     return fund
 
 
+def next_holdings_check(fund: Fund, today: datetime.date) -> datetime.date:
+    """
+    The day the fund's holdings should be fetched next. A due season is tried once, then again
+    after 1, 2, 4... days while it stays unpublished; a fund without any season is tried once a quarter.
+    """
+    due = disclosed_quarter(today)
+    quarter = season_quarter(fund.stock_season or fund.bond_season)
+    if quarter is not None and quarter >= due:
+        return next_disclosure(today)
+    checked = getattr(fund, "checked", None) or {}
+    tried = checked.get("quarter", None)
+    if tried is None or tuple(tried) < due or "holdings" not in checked:
+        return today
+    if quarter is None:
+        return next_disclosure(today)
+    last = checked["holdings"]
+    waited = last - (quarter_end(*due) + disclose_delay)
+    return last + min(max(waited, datetime.timedelta(days=1)), holdings_retry_max)
+
+
+def holdings_due(fund: Fund, today: datetime.date) -> bool:
+    return next_holdings_check(fund, today) <= today
+
+
+def refresh_fund(fund: Fund) -> Optional[Fund]:
+    """
+    Bring a cached fund up to date, refetching only what may have changed: holdings and
+    allocation once a new season is due, basic information and ratings every fund_info_refresh.
+    A part is only marked checked when its fetch succeeded.
+    """
+    today = datetime.date.today()
+    checked = dict(getattr(fund, "checked", None) or {})
+    fund = replace(fund)
+    try:
+        if today - checked.get("info", datetime.date.min) >= fund_info_refresh:
+            f = get_fund_info(fund.code)
+            if f:
+                fund.name = f['name']
+                fund.type = f['type']
+                fund.fee = f['fee']
+                checked["info"] = today
+            f = get_fund_extra(fund.code)
+            if f:
+                fund.manager = f['manager']
+                fund.company = f['company']
+                fund.recommand = f['recommend']
+
+        if holdings_due(replace(fund, checked=checked), today):
+            logger.info(f"checking new holdings of {fund.code} after {fund.stock_season}")
+            stock = get_fund_hold_stack(fund.code)
+            if stock:
+                fund.stock = stock
+            bond = get_fund_hold_bond(fund.code)
+            if bond:
+                fund.bond = bond
+            f = get_fund_scale(fund.code)
+            if f:
+                fund.scale = f["total_scale"]
+                fund._stock_share = f["stock_share"]
+                fund._bond_share = f["bond_share"]
+            # every fund has an allocation page, an empty holdings list alone may just be a bond or money fund
+            if f or stock or bond:
+                checked["holdings"] = today
+                checked["quarter"] = disclosed_quarter(today)
+    except Exception as e:
+        logger.error(f"refresh fund {fund.code} error: {e}")
+        return None
+    fund.checked = checked
+    return fund
+
+
+# whole-market tables are shared between workers for a while, a warm-up run downloads them once
+market_table_ttl = 600
+# whole-market tables a process holds in full at once, each is tens of MB before it is cut down
+table_loads = threading.BoundedSemaphore(getattr(settings, "FUND_TABLE_LOADS", 2))
+
+
+# akshare function -> the columns we use with their compact dtypes, the index column
+market_tables = {
+    "fund_purchase_em": ({"基金代码": "object", "基金简称": "object", "基金类型": "category", "手续费": "float64"}, "基金代码"),
+    "fund_rating_all": ({
+        "代码": "object", "基金经理": "object", "基金公司": "category",
+        "上海证券": "float32", "招商证券": "float32", "济安金信": "float32",
+    }, "代码"),
+    "stock_zh_a_spot_em": ({"代码": "object", "涨跌幅": "float64"}, None),
+    "stock_hk_spot_em": ({"代码": "object", "涨跌幅": "float64"}, None),
+    "stock_us_spot_em": ({"代码": "object", "涨跌幅": "float64"}, None),
+    "stock_zh_index_spot": ({"代码": "object", "名称": "object", "最新价": "float64", "涨跌幅": "float64"}, "代码"),
+}
+
+
+def load_table(name: str, columns: Dict[str, str], index: Optional[str] = None) -> pd.DataFrame:
+    """Whole-market akshare table cut down to the given columns and dtypes, the full frame is freed right away."""
+    with table_loads:
+        df = getattr(ak, name)()
+        table = df[list(columns)].astype(columns)
+        del df
+    if index is not None:
+        table = table.set_index(index)
+        table = table[~table.index.duplicated()]
+    return table
+
+
+def get_table(name: str, result_ttl: int = 10) -> pd.DataFrame:
+    columns, index = market_tables[name]
+    return call(load_table, name, columns, index, source=source_of(name), result_ttl=result_ttl)
+
+
 def get_fund_info(code: str):
-    fund_purchase_em_df = ak.fund_purchase_em()
-    selected_fund = None
+    fund_purchase_em_df = get_table("fund_purchase_em", result_ttl=market_table_ttl)
 
-    selected_fund = fund_purchase_em_df[fund_purchase_em_df.基金代码 == code]
     try:
-        selected_fund = selected_fund.iloc[0]
+        selected_fund = fund_purchase_em_df.loc[code]
         return {
-            "code": selected_fund['基金代码'],
+            "code": code,
             "name": selected_fund['基金简称'],
             "type": selected_fund['基金类型'],
             "fee": selected_fund['手续费'],
@@ -172,11 +290,10 @@ def get_fund_info(code: str):
 
 
 def get_fund_extra(code: str):
-    fund_rating_all_df = ak.fund_rating_all()
+    fund_rating_all_df = get_table("fund_rating_all", result_ttl=market_table_ttl)
 
     try:
-        selected_fund = fund_rating_all_df[fund_rating_all_df.代码 == code]
-        selected_fund = selected_fund.iloc[0]
+        selected_fund = fund_rating_all_df.loc[code]
 
         f = {
             "manager": selected_fund['基金经理'],
@@ -188,7 +305,7 @@ def get_fund_extra(code: str):
             value = selected_fund[name]
             if not value or math.isnan(value):
                 continue
-            f["recommend"].append({"name": name, "star": value})
+            f["recommend"].append({"name": name, "star": float(value)})
 
     except Exception as e:
         logger.error(f"get fund info error: {e}")
@@ -201,9 +318,9 @@ def get_fund_hold_stack(code: str):
 
     try:
         year = today.year
-        fund_portfolio_hold_em_df = ak.fund_portfolio_hold_em(symbol=code, date=f"{year}")
+        fund_portfolio_hold_em_df = call(ak.fund_portfolio_hold_em, symbol=code, date=f"{year}")
         if len(fund_portfolio_hold_em_df) == 0:
-            fund_portfolio_hold_em_df = ak.fund_portfolio_hold_em(symbol=code, date=f"{year-1}")
+            fund_portfolio_hold_em_df = call(ak.fund_portfolio_hold_em, symbol=code, date=f"{year-1}")
         if len(fund_portfolio_hold_em_df) == 0:
             return None
 
@@ -230,9 +347,9 @@ def get_fund_hold_bond(code: str):
     today = datetime.date.today()
     try:
         year = today.year
-        fund_portfolio_bond_hold_em = ak.fund_portfolio_bond_hold_em(symbol=code, date=f"{year}")
+        fund_portfolio_bond_hold_em = call(ak.fund_portfolio_bond_hold_em, symbol=code, date=f"{year}")
         if len(fund_portfolio_bond_hold_em) == 0:
-            fund_portfolio_bond_hold_em = ak.fund_portfolio_bond_hold_em(symbol=code, date=f"{year-1}")
+            fund_portfolio_bond_hold_em = call(ak.fund_portfolio_bond_hold_em, symbol=code, date=f"{year-1}")
         if len(fund_portfolio_bond_hold_em) == 0:
             return None
 
@@ -256,13 +373,14 @@ def get_fund_hold_bond(code: str):
 
 
 def get_fund_scale(code: str):
+    from bs4 import BeautifulSoup
     header = {
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36 Edg/115.0.1901.183"
     }
 
     try:
-        resp = requests.get(f"https://fundf10.eastmoney.com/zcpz_{code}.html", headers=header)
-        soup = BeautifulSoup(resp.text, 'html.parser')
+        text = call(get_text, f"https://fundf10.eastmoney.com/zcpz_{code}.html", source="eastmoney", headers=header)
+        soup = BeautifulSoup(text, 'html.parser')
 
         table = soup.find("table", attrs={"class": "w782 comm tzxq"})
 
@@ -309,6 +427,14 @@ class FundPrice(object):
     rate90: Optional[float] = None
     rate180: Optional[float] = None
     rate365: Optional[float] = None
+    rate_ytd: Optional[float] = None
+    # annualized, from the cumulative NAV
+    rate3y: Optional[float] = None
+    rate5y: Optional[float] = None
+    # over the last year
+    volatility: Optional[float] = None
+    sharpe: Optional[float] = None
+    max_drawdown: Optional[float] = None
 
     @property
     def show_rate_1(self):
@@ -334,30 +460,97 @@ class FundPrice(object):
     def show_rate_365(self):
         return f"{self.rate365*100:.2f}"
 
+    @property
+    def show_rate_ytd(self):
+        return f"{self.rate_ytd*100:.2f}" if self.rate_ytd is not None else "---"
 
-def get_price(code: str) -> Optional[FundPrice]:
+    @property
+    def show_rate_3y(self):
+        return f"{self.rate3y*100:.2f}" if self.rate3y is not None else "---"
+
+    @property
+    def show_rate_5y(self):
+        return f"{self.rate5y*100:.2f}" if self.rate5y is not None else "---"
+
+    @property
+    def show_volatility(self):
+        return f"{self.volatility*100:.2f}" if self.volatility is not None else "---"
+
+    @property
+    def show_sharpe(self):
+        return f"{self.sharpe:.2f}" if self.sharpe is not None else "---"
+
+    @property
+    def show_max_drawdown(self):
+        return f"{self.max_drawdown*100:.2f}" if self.max_drawdown is not None else "---"
+
+
+def get_nav(code: str) -> Optional[Dict[str, np.ndarray]]:
+    """Whole NAV history of a fund as arrays: date, unit and cumulative NAV, daily rate."""
+    try:
+        unit_df = call(ak.fund_open_fund_info_em, fund=code, indicator="单位净值走势")
+        cum_df = call(ak.fund_open_fund_info_em, fund=code, indicator="累计净值走势")
+        df = unit_df.merge(cum_df[["净值日期", "累计净值"]], on="净值日期", how="left")
+        if len(df) == 0:
+            return None
+        return {
+            "date": pd.to_datetime(df["净值日期"]).to_numpy(dtype="datetime64[D]"),
+            "unit": df["单位净值"].to_numpy(dtype=np.float64),
+            "cum": df["累计净值"].to_numpy(dtype=np.float64),
+            "rate": df["日增长率"].to_numpy(dtype=np.float64) / 100,
+        }
+    except Exception as e:
+        logger.error(f"get nav error: {e}")
+        return None
+
+
+risk_free_rate = 0.02
+trading_days = 252
+# daily returns the 1 year risk figures need, a shorter history annualizes into noise
+min_risk_returns = 60
+
+
+def get_price(code: str, nav: Optional[Dict[str, np.ndarray]] = None) -> Optional[FundPrice]:
     result = FundPrice(code=code)
     try:
-        fund_open_fund_info_em_df = ak.fund_open_fund_info_em(fund=code, indicator="单位净值走势")
-        last_elem = fund_open_fund_info_em_df.iloc[-1]
-        result.last_day = last_elem["净值日期"]
-        result.unit_price = last_elem["单位净值"]
-        result.rate1 = last_elem["日增长率"] / 100
-
-        dd = ak.fund_open_fund_info_em(fund=code, indicator="累计净值走势")
-        last_elem = dd.iloc[-1]
-        result.cum_price = last_elem["累计净值"]
-
-        for diff_day in [7, 30, 90, 180, 365]:
-            try:
-                start_day = result.last_day - datetime.timedelta(days=diff_day)
-                price = fund_open_fund_info_em_df[fund_open_fund_info_em_df.净值日期 >= start_day]
-                start_elem = price.iloc[0]
-                start_price = start_elem["单位净值"]
-                setattr(result, f"rate{diff_day}", result.unit_price/start_price - 1)
-            except Exception as e:
-                logger.error(f"get price diff_day {diff_day} error: {e}")
-                pass
+        if nav is None:
+            nav = get_nav(code)
+        dates = nav["date"]
+        unit = nav["unit"]
+        cum = nav["cum"]
+        last = dates[-1]
+        result.last_day = last.astype(datetime.date)
+        result.unit_price = float(unit[-1])
+        result.rate1 = float(nav["rate"][-1])
+        result.cum_price = float(cum[-1])
+
+        # every window start in one searchsorted over the sorted dates
+        diff_days = [7, 30, 90, 180, 365]
+        year_start = np.datetime64(f"{result.last_day.year}-01-01")
+        bounds = np.array([last - np.timedelta64(d, "D") for d in diff_days] + [year_start, last - np.timedelta64(365 * 3, "D"), last - np.timedelta64(365 * 5, "D")])
+        starts = np.searchsorted(dates, bounds, side="left")
+
+        for diff_day, start in zip(diff_days, starts):
+            if start < len(dates):
+                setattr(result, f"rate{diff_day}", result.unit_price/unit[start] - 1)
+
+        # the year's return counts from the last NAV of the previous year
+        ytd, y3, y5 = starts[len(diff_days):]
+        if ytd > 0:
+            result.rate_ytd = float(cum[-1] / cum[ytd - 1] - 1)
+        for attr, start, years in [("rate3y", y3, 3), ("rate5y", y5, 5)]:
+            if start > 0:
+                setattr(result, attr, float((cum[-1] / cum[start]) ** (1 / years) - 1))
+
+        year = starts[diff_days.index(365)]
+        rates = nav["rate"][year+1:]
+        rates = rates[~np.isnan(rates)]
+        if len(rates) >= min_risk_returns:
+            result.volatility = float(np.std(rates, ddof=1) * np.sqrt(trading_days))
+            if result.volatility > 0:
+                result.sharpe = float((np.mean(rates) * trading_days - risk_free_rate) / result.volatility)
+            window = cum[year:]
+            result.max_drawdown = float(np.min(window / np.maximum.accumulate(window) - 1))
     except Exception as e:
         logger.error(f"get price error: {e}")
         return None
@@ -365,172 +558,392 @@ def get_price(code: str) -> Optional[FundPrice]:
     return result
 
 
-def get_rt_factor():
-    rt_price_timeout = 300
-    now = cache.get("rt_now", default=None)
-    if now is None:
-        try:
-            now = datetime.datetime.now()
-            cache.set("rt_now", now, rt_price_timeout)
-        except Exception as e:
-            logger.error(f"get rt now error: {e}")
-            now = None
-    rt_factor_cache_timeout = rt_price_timeout
-    a_stocks = cache.get("rt_a_stocks", default=None)
-    if a_stocks is None:
-        try:
-            a_stocks_tmp = ak.stock_zh_a_spot_em()
-            a_stocks = {}
-            for _, row in a_stocks_tmp.iterrows():
-                a_stocks[row["代码"]] = row["涨跌幅"] / 100
-        except Exception as e:
-            logger.error(f"get rt a stocks error: {e}")
-            a_stocks = None
-        if a_stocks:
-            logger.info(a_stocks)
-            cache.set("rt_a_stocks", a_stocks, rt_factor_cache_timeout)
-            logger.info(a_stocks)
-
-    h_stocks = cache.get("rt_h_stocks", default=None)
-    if h_stocks is None:
-        try:
-            h_stocks_tmp = ak.stock_hk_spot_em()
-            h_stocks = {}
-            for _, row in h_stocks_tmp.iterrows():
-                h_stocks[row["代码"]] = row["涨跌幅"] / 100
-        except Exception as e:
-            logger.error(f"get rt h stocks error: {e}")
-            h_stocks = None
-        if h_stocks:
-            cache.set("rt_h_stocks", h_stocks, rt_factor_cache_timeout)
+fund_cache_timeout = 86400 * 15
+fundprice_cache_timeout = 60*60*24
+# basic information and ratings change slowly, a cached fund rechecks them this often
+fund_info_refresh = datetime.timedelta(days=30)
+# longest wait between retries of a season that is due but not published yet
+holdings_retry_max = datetime.timedelta(days=8)
+# the last good copy, served while upstream is unavailable
+stale_cache_timeout = 86400 * 60
 
-    m_stocks = cache.get("rt_m_stocks", default=None)
-    if m_stocks is None:
-        try:
-            m_stocks_tmp = ak.stock_us_spot_em()
-            m_stocks = {}
-            for _, row in m_stocks_tmp.iterrows():
-                code = row["代码"]
-                if "." in code:
-                    code = code.split(".")[1]
-                m_stocks[code] = row["涨跌幅"] / 100
-        except Exception as e:
-            logger.error(f"get rt m stocks error: {e}")
-            m_stocks = None
-        if m_stocks:
-            cache.set("rt_m_stocks", m_stocks, rt_factor_cache_timeout)
 
-    bond_index = cache.get("rt_bond_index", default=None)
-    if bond_index is None:
+def fund_timeout(fund: Fund) -> int:
+    """Seconds until some part of the fund may change: the next holdings check or information refresh, at least a day."""
+    today = datetime.date.today()
+    due = next_holdings_check(fund, today)
+    checked = getattr(fund, "checked", None) or {}
+    if "info" in checked:
+        due = min(due, checked["info"] + fund_info_refresh)
+    return max((due - today).days, 1) * 86400
+
+
+def get_fund_cache(code: str) -> Optional[Fund]:
+    key = f"fund-{code}"
+    try:
+        fund = cache.get(key, default=None)
+        if not fund:
+            last = cache.get(f"{key}-last", default=None)
+            fund = refresh_fund(last) if last else get_fund(code)
+            if fund:
+                cache.set(key, fund, fund_timeout(fund))
+                cache.set(f"{key}-last", fund, stale_cache_timeout)
+                FundHolding.update_fund(fund)
+            else:
+                fund = last
+    except Exception as e:
+        logger.error(f"error getting fund {code}: {e}")
+        return None
+    return fund
+
+
+def get_nav_cache(code: str) -> Optional[Dict[str, np.ndarray]]:
+    key = f"nav-{code}"
+
+    try:
+        nav = cache.get(key, default=None)
+        if nav is None:
+            nav = get_nav(code)
+            if nav:
+                cache.set(key, nav, fundprice_cache_timeout)
+    except Exception as e:
+        logger.error(f"error getting fund nav {code}: {e}")
+        return None
+    return nav
+
+
+def get_fundprice_cache(code: str) -> Optional[FundPrice]:
+    key = f"fundprice-{code}"
+
+    try:
+        fundprice = cache.get(key, default=None)
+        if not fundprice:
+            nav = get_nav_cache(code)
+            fundprice = get_price(code, nav) if nav else None
+            if fundprice:
+                cache.set(key, fundprice, fundprice_cache_timeout)
+                cache.set(f"{key}-last", fundprice, stale_cache_timeout)
+            else:
+                fundprice = cache.get(f"{key}-last", default=None)
+    except Exception as e:
+        logger.error(f"error getting fund price {code}: {e}")
+        return None
+    return fundprice
+
+
+rt_price_timeout = 300
+
+
+def get_rt_version() -> Optional[datetime.datetime]:
+    """Time of the latest factor table refresh, without loading the tables."""
+    return cache.get("rt_now", default=None)
+
+
+def get_rt_max_age() -> int:
+    """Seconds until the next scheduled factor refresh of any market."""
+    return min(refresh_timeout(market) for market in MARKETS)
+
+
+def fetch_a_stocks():
+    a_stocks_tmp = get_table("stock_zh_a_spot_em")
+    return dict(zip(a_stocks_tmp["代码"].tolist(), (a_stocks_tmp["涨跌幅"] / 100).tolist()))
+
+
+def fetch_h_stocks():
+    h_stocks_tmp = get_table("stock_hk_spot_em")
+    return dict(zip(h_stocks_tmp["代码"].tolist(), (h_stocks_tmp["涨跌幅"] / 100).tolist()))
+
+
+def fetch_m_stocks():
+    m_stocks_tmp = get_table("stock_us_spot_em")
+    codes = m_stocks_tmp["代码"].str.split(".").str[-1]
+    return dict(zip(codes.tolist(), (m_stocks_tmp["涨跌幅"] / 100).tolist()))
+
+
+def fetch_bond_index():
+    bond_index = {}
+    bond__normal_index = call(ak.bond_new_composite_index_cbond, indicator="财富", period="总值")
+    start_price = bond__normal_index.iloc[-2]["value"]
+    end_price = bond__normal_index.iloc[-1]["value"]
+    bond_rate = end_price/start_price-1
+    bond_index["bond"] = bond_rate
+    bond_cb_index = call(ak.bond_cb_index_jsl)
+    bond_cb_rate = bond_cb_index.iloc[-1]["increase_val"] / 100
+    bond_index["bond_cb"] = bond_cb_rate
+    return bond_index
+
+
+# cache key, fetcher and the market whose sessions drive the refresh
+rt_factor_sources = [
+    ("rt_a_stocks", fetch_a_stocks, "a"),
+    ("rt_h_stocks", fetch_h_stocks, "h"),
+    ("rt_m_stocks", fetch_m_stocks, "m"),
+    ("rt_bond_index", fetch_bond_index, "a"),
+]
+
+
+def get_rt_table(key: str, fetch, market: str):
+    table = cache.get(key, default=None)
+    if table is None:
         try:
-            bond_index = {}
-            bond__normal_index = ak.bond_new_composite_index_cbond(indicator="财富", period="总值")
-            start_price = bond__normal_index.iloc[-2]["value"]
-            end_price = bond__normal_index.iloc[-1]["value"]
-            bond_rate = end_price/start_price-1
-            bond_index["bond"] = bond_rate
-            bond_cb_index = ak.bond_cb_index_jsl()
-            bond_cb_rate = bond_cb_index.iloc[-1]["increase_val"] / 100
-            bond_index["bond_cb"] = bond_cb_rate
+            table = fetch()
         except Exception as e:
-            logger.error(f"get rt bond index error: {e}")
-            bond_index = None
-        if bond_index:
-            cache.set("rt_bond_index", bond_index, rt_factor_cache_timeout)
+            logger.error(f"get {key} error: {e}")
+            table = None
+        if table:
+            timeout = refresh_timeout(market)
+            logger.info(f"refreshed {key}, next refresh in {timeout}s")
+            cache.set(key, table, timeout)
+            cache.set(f"{key}-last", table, None)
+            cache.set("rt_now", datetime.datetime.now(), None)
+        else:
+            # keep serving the last table without touching rt_now, and retry on the next interval
+            table = cache.get(f"{key}-last", default=None)
+            if table:
+                cache.set(key, table, getattr(settings, "FUND_RT_INTERVAL", 60))
+    return table
 
+
+def get_rt_factor():
+    a_stocks, h_stocks, m_stocks, bond_index = [get_rt_table(key, fetch, market) for key, fetch, market in rt_factor_sources]
+    now = get_rt_version()
     return now, a_stocks, h_stocks, m_stocks, bond_index
 
 
-def get_rt_price(fund: Fund) -> Optional[float]:
+def publish_rt_factors() -> float:
+    """Publish the current factor tables for workers to map, returns when the publication goes stale."""
     now, a_stocks, h_stocks, m_stocks, bond_index = get_rt_factor()
-    logger.info(f"getting rt price for {fund.code} time {now}")
-    stock_share_all = fund.stock_share
-    bond_share_all = fund.bond_share
+    expires = time.time() + get_rt_max_age()
+    publish_factors(FactorTable.from_dicts([a_stocks, h_stocks, m_stocks], bond_index, now, expires))
+    return expires
+
+
+_built: Optional[FactorTable] = None
+
+
+def get_rt_factor_table():
+    """
+    The factor tables as published by the refresher when that publication is current,
+    otherwise read from the cache (refetching expired ones) and built once per version in this worker.
+    """
+    global _built
+    now = get_rt_version()
+    factors = get_mapped_factors()
+    if factors is not None and now is not None and factors.version == now and time.time() < factors.expires:
+        return now, factors
+    if _built is not None and now is not None and _built.version == now:
+        return now, _built
+    now, a_stocks, h_stocks, m_stocks, bond_index = get_rt_factor()
+    factors = FactorTable.from_dicts([a_stocks, h_stocks, m_stocks], bond_index, now)
+    if now is not None:
+        _built = factors
+    return now, factors
+
+
+@dataclass
+class Estimate(object):
+    rate: float
+    # part of the stock holdings priced from the fund's own disclosed holdings
+    coverage: float = 0
+    # part of the fund estimated through a market index proxy
+    proxy_share: float = 0
+    # historical bias of the estimate against the actual NAV change, already added to rate
+    residual: float = 0
+
+    @property
+    def show_coverage(self):
+        return f"{self.coverage*100:.0f}"
+
+
+def market_of(code: str) -> int:
+    """0 A-share, 1 HK, 2 US, guessed from the code format of holdings we cannot price."""
+    if code.isdigit():
+        return 0 if len(code) == 6 else 1
+    return 2
+
+
+def get_benchmark_rate() -> Optional[float]:
+    """Return of the A-share benchmark from the index panel, None when the panel lacks it."""
+    for idx in cache.get("china_index", default=None) or []:
+        if idx["code"] == "sh000300":
+            return idx["rate"] / 100
+    return None
+
+
+def get_proxy_rates(factors: FactorTable) -> np.ndarray:
+    """Market-wide return of the A, HK and US markets, standing in for unpriced holdings."""
+    proxies = factors.medians()
+    benchmark = get_benchmark_rate()
+    if benchmark is not None:
+        proxies[0] = benchmark
+    return proxies
 
-    stock_share_account = 0
-    stock_price_total = 0
-    for stock in fund.stock:
-        try:
-            stock_code = stock['code']
-            stock_share = stock['share']
-
-            if stock_code in a_stocks:
-                stock_price = a_stocks[stock_code]
-            elif stock_code in h_stocks:
-                stock_price = h_stocks[stock_code]
-            elif stock_code in m_stocks:
-                stock_price = m_stocks[stock_code]
-            else:
-                continue
-            logger.debug(f"update stock rate: {stock_code} {stock_price} {stock_share}")
-            stock_share_account += stock_share
-            stock_price_total += stock_share * stock_price
-        except Exception:
-            traceback.print_exc()
-            continue
-    logger.debug(stock_share_account)
-    stock_evaluate_rate = stock_price_total / stock_share_account if stock_share_account > 0 else 0
-    logger.debug(f"update avg stock rate: {stock_evaluate_rate}")
+
+def get_rt_price(fund: Fund) -> Optional[float]:
+    now, estimates = get_rt_estimates([fund])
+    logger.info(f"getting rt price for {fund.code} time {now}")
+    return now, estimates[fund.code].rate
+
+
+def get_rt_prices(funds: List[Fund]):
+    """Estimates of many funds against one read of the factor tables."""
+    now, estimates = get_rt_estimates(funds)
+    return now, {code: e.rate for code, e in estimates.items()}
+
+
+estimates_cache_timeout = 86400
+_stored: Tuple[Optional[datetime.datetime], Dict[str, "Estimate"]] = (None, {})
+
+
+def precompute_estimates(funds: List[Fund]):
+    """Estimate a batch of funds once and store them under the factor version, page views then look them up."""
+    now, factors = get_rt_factor_table()
+    estimates = evaluate_rt_prices(funds, factors)
+    if now is not None:
+        cache.set(f"estimates-{now}", estimates, estimates_cache_timeout)
+        logger.info(f"precomputed {len(estimates)} estimates at {now}")
+    return now, estimates
+
+
+def get_stored_estimates(now: datetime.datetime) -> Dict[str, "Estimate"]:
+    """The precomputed estimates of a factor version, read once per version in this worker."""
+    global _stored
+    if _stored[0] != now:
+        estimates = cache.get(f"estimates-{now}", default=None)
+        if estimates is None:
+            return {}
+        _stored = (now, estimates)
+    return _stored[1]
+
+
+def get_rt_estimates(funds: List[Fund]):
+    now = get_rt_version()
+    stored = get_stored_estimates(now) if now is not None else {}
+    estimates = {f.code: stored[f.code] for f in funds if f.code in stored}
+    missing = [f for f in funds if f.code not in stored]
+    if missing:
+        now, factors = get_rt_factor_table()
+        estimates.update(evaluate_rt_prices(missing, factors))
+    logger.info(f"getting rt price for {len(funds)} funds time {now}, {len(funds) - len(missing)} precomputed")
+    return now, estimates
+
+
+def fund_sums(funds: np.ndarray, values: np.ndarray, n: int) -> np.ndarray:
+    """Sum of holding values per fund, over the last axis of (holdings,) or (days, holdings) values."""
+    values = np.asarray(values, dtype=np.float64)
+    if values.ndim == 1:
+        return np.bincount(funds, weights=values, minlength=n)
+    days = values.shape[0]
+    index = (np.arange(days)[:, None] * n + funds).ravel()
+    return np.bincount(index, weights=values.ravel(), minlength=days * n).reshape(days, n)
+
+
+def combine_estimates(stock_funds: np.ndarray, stock_weights: np.ndarray, price: np.ndarray, proxy: np.ndarray,
+                      default_proxy, stock_share: np.ndarray, bond_return, residual: np.ndarray, n: int):
+    """
+    The estimator shared by the live estimates and the backtest: rate, coverage and proxy share of n funds.
+    Priced holdings count at their own return, NaN prices and the stock share beyond the disclosed
+    top holdings at their market's proxy (default_proxy for a fund without holdings), then the bond
+    part's return and the fund's residual are added. price and proxy are (holdings,) or (days, holdings).
+    """
+    priced = ~np.isnan(price)
+    covered = fund_sums(stock_funds, stock_weights * priced, n)
+    head = np.bincount(stock_funds, weights=stock_weights, minlength=n)
+    stock_rate = fund_sums(stock_funds, stock_weights * np.where(priced, price, proxy), n)
+
+    # the rest of the stock share moves with the markets the fund is invested in
+    mix = fund_sums(stock_funds, stock_weights * proxy, n)
+    default = np.broadcast_to(np.asarray(default_proxy, dtype=np.float64), mix.shape).copy()
+    mix = np.divide(mix, head, out=default, where=head > 0)
+    rest = np.maximum(stock_share - head, 0)
+    stock_rate += rest * mix
+
+    rate = stock_rate + bond_return + residual
+    stock_total = np.maximum(stock_share, head)
+    coverage = np.divide(covered, stock_total, out=np.zeros(covered.shape), where=stock_total > 0)
+    proxy_share = (head - covered) + rest
+    return rate, coverage, proxy_share
+
+
+def evaluate_rt_prices(funds: List[Fund], factors: FactorTable) -> Dict[str, Estimate]:
+    """
+    Estimate all funds at once over the long table of their holdings, see combine_estimates;
+    bonds count at the bond indices, other assets (cash) at zero.
+    """
+    if not funds:
+        return {}
+    n = len(funds)
+
+    stock_codes = [s["code"] for f in funds for s in f.stock]
+    stock_weights = np.array([s["share"] for f in funds for s in f.stock], dtype=np.float64) / 100
+    stock_funds = np.repeat(np.arange(n), [len(f.stock) for f in funds])
+
+    inverse, uniq = pd.factorize(pd.Series(stock_codes, dtype=object))
+    prices, markets = factors.lookup([str(code) for code in uniq])
+    for i in np.flatnonzero(markets < 0):
+        markets[i] = market_of(str(uniq[i]))
+    proxies = get_proxy_rates(factors)
+    stock_share = np.array([f.stock_share for f in funds], dtype=np.float64)
 
     try:
+        bond_index = factors.bond_index
         bond_rate = bond_index["bond"]
-        logger.debug(f"update avg bond rate: {bond_rate}")
         bond_cb_rate = bond_index["bond_cb"]
-        logger.debug(f"update avg bond cb rate: {bond_cb_rate}")
     except Exception as e:
         logger.error(f"update avg bond error: {e}")
         bond_rate = 0
         bond_cb_rate = 0
+    bond_funds = np.repeat(np.arange(n), [len(f.bond) for f in funds])
+    bond_weights = np.array([b["share"] for f in funds for b in f.bond], dtype=np.float64)
+    bond_cb = np.array(["转" in b["name"] for f in funds for b in f.bond], dtype=bool)
+    bond_total = np.bincount(bond_funds, weights=bond_weights, minlength=n)
+    bond_sum = np.bincount(bond_funds, weights=bond_weights * np.where(bond_cb, bond_cb_rate, bond_rate), minlength=n)
+    bond_evaluate_rate = np.divide(bond_sum, bond_total, out=np.zeros(n), where=bond_total > 0)
+    bond_share = np.array([f.bond_share for f in funds], dtype=np.float64)
+
+    residuals = cache.get_many([f"residual-{f.code}" for f in funds])
+    residual = np.array([residuals.get(f"residual-{f.code}", 0) for f in funds], dtype=np.float64)
+
+    rate, coverage, proxy_share = combine_estimates(
+        stock_funds, stock_weights, prices[inverse], proxies[markets[inverse]], proxies[0],
+        stock_share, bond_share * bond_evaluate_rate, residual, n)
+
+    result = {}
+    for i, fund in enumerate(funds):
+        result[fund.code] = Estimate(rate=float(rate[i]), coverage=float(coverage[i]), proxy_share=float(proxy_share[i]), residual=float(residual[i]))
+        logger.debug(f"update evaluated: {fund.code} {result[fund.code]}")
+    return result
 
-    bond_share_total = 0
-    bond_cb_share_total = 0
-    for b in fund.bond:
-        try:
-            name = b["name"]
-            share = b["share"]
-
-            if "转" in name:
-                bond_cb_share_total += share
-            else:
-                bond_share_total += share
-        except Exception:
-            continue
-
-    bond_evaluate_rate = (bond_cb_rate * bond_cb_share_total + bond_rate * bond_share_total)/(bond_cb_share_total+bond_share_total) if bond_cb_share_total+bond_share_total > 0 else 0
-
-    logger.debug(f"update avg stock rate: {bond_evaluate_rate} bond_share: {bond_share_total} bond_rate: {bond_rate} bond_cb_share: {bond_cb_share_total} bond_cb_rate: {bond_cb_rate}")
 
-    evaluate_rate = stock_share_all * stock_evaluate_rate + bond_evaluate_rate * bond_share_all
-    logger.debug(f"update evaluated: {evaluate_rate} {stock_evaluate_rate}({stock_share_all}) {bond_evaluate_rate}({bond_share_all})")
-    return now, evaluate_rate
+def refresh_index():
+    """Fetch the index panel, keeping the last good panel when upstream fails."""
+    codes = getattr(settings, "FUND_INDEX_CODES", ["sh000001", "sh000300", "sh000016", "sz399006"])
+    try:
+        df = get_table("stock_zh_index_spot")
+        rows = df.reindex(codes).dropna(subset=["名称"])
+        china_index = [{
+            "name": row["名称"],
+            "code": code,
+            "price": row["最新价"],
+            "rate": row["涨跌幅"],
+        } for code, row in rows.iterrows()]
+    except Exception as e:
+        logger.error(f"get index error: {e}")
+        china_index = None
+    if not china_index:
+        # retry soon, but not on every request
+        cache.set("index_fresh", False, getattr(settings, "FUND_RT_INTERVAL", 60))
+        return
+    cache.set("index_fresh", True, refresh_timeout("a"))
+    cache.set_many({"china_index": china_index, "index_now": datetime.datetime.now()}, None)
 
 
 def get_index():
-    index_cache_timeout = 300
-    now = cache.get("index_now", default=None)
-    if now is None:
-        try:
-            now = datetime.datetime.now()
-            cache.set("index_now", now, index_cache_timeout)
-        except Exception as e:
-            logger.error(f"get index now error: {e}")
-            now = None
-    china_index = cache.get("china_index", default=None)
-    if china_index is None:
-        tmp_index = []
-        stock_zh_index_spot_df = ak.stock_zh_index_spot()
-        for code in ["sh000001", "sh000300", "sh000016", "sz399006"]:
-            row = stock_zh_index_spot_df[stock_zh_index_spot_df["代码"] == code].iloc[0]
-            tmp_index.append({
-                "name": row["名称"],
-                "code": row["代码"],
-                "price": row["最新价"],
-                "rate": row["涨跌幅"],
-            })
-            logger.debug(row)
-        if len(tmp_index) > 0:
-            china_index = tmp_index
-            cache.set("china_index", china_index, index_cache_timeout)
+    """The index panel as last refreshed by the refresher, fetched here only when nothing is cached."""
+    now, china_index = [cache.get(key, default=None) for key in ("index_now", "china_index")]
+    if china_index is None and cache.get("index_fresh", default=None) is None:
+        refresh_index()
+        now, china_index = [cache.get(key, default=None) for key in ("index_now", "china_index")]
     return now, china_index
 
 
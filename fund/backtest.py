@@ -0,0 +1,204 @@
+from typing import Dict, List, Optional
+from dataclasses import dataclass
+import datetime
+import logging
+import time
+import warnings
+import numpy as np
+import pandas as pd
+from .api import combine_estimates, get_nav_cache, market_of
+from .market import disclose_delay, quarter_end, season_quarter
+from .series import get_spots
+from .upstream import ak, call
+
+logger = logging.getLogger("root")
+
+
+@dataclass
+class BacktestResult(object):
+    estimate: pd.DataFrame
+    actual: pd.DataFrame
+    stats: pd.DataFrame
+    summary: Dict[str, float]
+
+
+def season_start(season: str) -> Optional[datetime.date]:
+    """First day a season's holdings were known, from e.g. `2023年2季度股票投资明细`."""
+    quarter = season_quarter(season)
+    if quarter is None:
+        return None
+    # an estimate only sees the holdings once they are published
+    return quarter_end(*quarter) + disclose_delay
+
+
+def load_holdings(codes: List[str], start: datetime.date, end: datetime.date) -> pd.DataFrame:
+    """Every season's top holdings of the funds, columns fund/start/stock/share."""
+    frames = []
+    for code in codes:
+        for year in range(start.year - 1, end.year + 1):
+            try:
+                df = call(ak.fund_portfolio_hold_em, symbol=code, date=f"{year}")
+            except Exception as e:
+                logger.error(f"get holdings {code} {year} error: {e}")
+                continue
+            if len(df) == 0:
+                continue
+            frames.append(pd.DataFrame({
+                "fund": code,
+                "start": df["季度"].map(season_start),
+                "stock": df["股票代码"],
+                "share": df["占净值比例"].astype(float),
+            }))
+    if not frames:
+        return pd.DataFrame(columns=["fund", "start", "stock", "share"])
+    holdings = pd.concat(frames, ignore_index=True).dropna(subset=["start"])
+    return holdings.drop_duplicates(["fund", "start", "stock"])
+
+
+def load_nav_rates(codes: List[str], start: datetime.date, end: datetime.date) -> pd.DataFrame:
+    """Actual daily NAV change (`rate1`), dates x funds."""
+    columns = {}
+    for code in codes:
+        nav = get_nav_cache(code)
+        if nav is None:
+            continue
+        mask = (nav["date"] >= np.datetime64(start)) & (nav["date"] <= np.datetime64(end))
+        columns[code] = pd.Series(nav["rate"][mask], index=nav["date"][mask])
+    return pd.DataFrame(columns)
+
+
+def load_returns(start: datetime.date, end: datetime.date) -> pd.DataFrame:
+    """Recorded daily stock returns, dates x stocks."""
+    days = [start + datetime.timedelta(days=i) for i in range((end - start).days + 1)]
+    spots = get_spots(days)
+    columns = {day: pd.Series(spot["values"], index=spot["codes"]) for day, spot in sorted(spots.items())}
+    if not columns:
+        return pd.DataFrame()
+    return pd.DataFrame(columns).T
+
+
+def market_medians(R: np.ndarray, codes: pd.Index) -> np.ndarray:
+    """Median return of the A, HK and US markets on each day, zero for a market without data, as FactorTable.medians."""
+    markets = np.array([market_of(str(code)) for code in codes], dtype=np.int64)
+    medians = np.zeros((len(R), 3))
+    with warnings.catch_warnings():
+        # days a market has no recorded returns
+        warnings.simplefilter("ignore", RuntimeWarning)
+        for m in range(3):
+            if (markets == m).any():
+                medians[:, m] = np.nanmedian(R[:, markets == m], axis=1)
+    return np.nan_to_num(medians)
+
+
+def estimate(returns: pd.DataFrame, holdings: pd.DataFrame, stock_share: Optional[pd.Series] = None,
+             residual: Optional[pd.Series] = None) -> pd.DataFrame:
+    """
+    The live estimator, combine_estimates, replayed for every fund on every day with each day's market
+    medians as proxies. Bond index returns are not recorded, so the bond part counts at zero, and the
+    A-share proxy is not replaced by the benchmark index.
+    Only one loop, over holdings periods; within a period all days and funds go through one gather and reduce.
+    """
+    dates = pd.to_datetime(returns.index).to_numpy()
+    stock_index = pd.Index(returns.columns)
+    R = returns.to_numpy(dtype=np.float64)
+    proxies = market_medians(R, stock_index)
+
+    # holdings missing from the recorded returns are unpriced, they count at their market's proxy
+    holdings = holdings.assign(
+        s=stock_index.get_indexer(holdings["stock"]),
+        m=[market_of(str(code)) for code in holdings["stock"]],
+        start=pd.to_datetime(holdings["start"]),
+    )
+    funds = pd.Index(sorted(holdings["fund"].unique()))
+    result = np.full((len(dates), len(funds)), np.nan)
+    if len(funds) == 0:
+        return pd.DataFrame(result, index=returns.index, columns=funds)
+
+    if stock_share is not None:
+        share = stock_share.reindex(funds).to_numpy(dtype=np.float64)
+    else:
+        share = np.full(len(funds), np.nan)
+    if residual is not None:
+        bias = residual.reindex(funds).fillna(0).to_numpy(dtype=np.float64)
+    else:
+        bias = np.zeros(len(funds))
+
+    # each fund uses its latest season known on the day: one holdings set per (period, fund)
+    periods = np.sort(holdings["start"].unique())
+    grid = pd.DataFrame({
+        "period": np.repeat(periods, len(funds)),
+        "fund": np.tile(funds, len(periods)),
+    }).sort_values("period")
+    seasons = holdings[["fund", "start"]].drop_duplicates().sort_values("start")
+    grid = pd.merge_asof(grid, seasons, left_on="period", right_on="start", by="fund").dropna(subset=["start"])
+    active = grid.merge(holdings, on=["fund", "start"])
+    active["f"] = funds.get_indexer(active["fund"])
+
+    period_of_day = np.searchsorted(periods, dates, side="right") - 1
+    for p, period in enumerate(periods):
+        rows = np.nonzero(period_of_day == p)[0]
+        if len(rows) == 0:
+            continue
+        triples = active[active["period"] == period]
+        fs, local = np.unique(triples["f"].to_numpy(), return_inverse=True)
+        s = triples["s"].to_numpy()
+        w = triples["share"].to_numpy(dtype=np.float64) / 100
+
+        price = np.full((len(rows), len(s)), np.nan)
+        listed = s >= 0
+        price[:, listed] = R[np.ix_(rows, s[listed])]
+        proxy = proxies[rows][:, triples["m"].to_numpy()]
+        # without a known stock share, a season's top holdings stand for the whole stock part
+        head = np.bincount(local, weights=w, minlength=len(fs))
+        fund_share = np.where(np.isnan(share[fs]), head, share[fs])
+
+        rate, _, _ = combine_estimates(local, w, price, proxy, proxies[rows, 0][:, None], fund_share, 0, bias[fs], len(fs))
+        result[np.ix_(rows, fs)] = rate
+    return pd.DataFrame(result, index=returns.index, columns=funds)
+
+
+def error_stats(est: pd.DataFrame, actual: pd.DataFrame) -> pd.DataFrame:
+    E = est.to_numpy(dtype=float)
+    A = actual.to_numpy(dtype=float)
+    valid = ~np.isnan(E) & ~np.isnan(A)
+    n = valid.sum(axis=0)
+    err = np.where(valid, E - A, 0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mae = np.abs(err).sum(axis=0) / n
+        rmse = np.sqrt((err ** 2).sum(axis=0) / n)
+        bias = err.sum(axis=0) / n
+        hit = (np.where(valid, np.sign(E) == np.sign(A), False)).sum(axis=0) / n
+        e0 = np.where(valid, E - np.nansum(np.where(valid, E, 0), axis=0) / n, 0)
+        a0 = np.where(valid, A - np.nansum(np.where(valid, A, 0), axis=0) / n, 0)
+        corr = (e0 * a0).sum(axis=0) / np.sqrt((e0 ** 2).sum(axis=0) * (a0 ** 2).sum(axis=0))
+    return pd.DataFrame({"days": n, "mae": mae, "rmse": rmse, "bias": bias, "corr": corr, "hit": hit}, index=est.columns)
+
+
+def backtest(returns: pd.DataFrame, holdings: pd.DataFrame, nav: pd.DataFrame, stock_share: Optional[pd.Series] = None,
+             residual: Optional[pd.Series] = None) -> BacktestResult:
+    returns = returns.set_axis(pd.to_datetime(returns.index), axis=0)
+    nav = nav.set_axis(pd.to_datetime(nav.index), axis=0)
+    dates = returns.index.intersection(nav.index).sort_values()
+    returns = returns.loc[dates]
+
+    begin = time.perf_counter()
+    est = estimate(returns, holdings, stock_share, residual)
+    cost = time.perf_counter() - begin
+
+    funds = est.columns.intersection(nav.columns)
+    est = est[funds]
+    actual = nav.loc[dates, funds]
+    stats = error_stats(est, actual)
+
+    valid = stats["days"] > 0
+    summary = {
+        "funds": int(valid.sum()),
+        "days": len(dates),
+        "mae": float((stats["mae"] * stats["days"])[valid].sum() / max(1, stats["days"].sum())),
+        "median_mae": float(stats["mae"][valid].median()) if valid.any() else float("nan"),
+        "median_corr": float(stats["corr"][valid].median()) if valid.any() else float("nan"),
+        "hit": float((stats["hit"] * stats["days"])[valid].sum() / max(1, stats["days"].sum())),
+        "seconds": cost,
+        "estimates_per_second": est.size / cost if cost > 0 else float("inf"),
+    }
+    return BacktestResult(estimate=est, actual=actual, stats=stats, summary=summary)
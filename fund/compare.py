@@ -0,0 +1,98 @@
+from typing import Any, Dict, List, Optional
+import datetime
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+from django.core.cache import cache
+from .api import get_nav, fundprice_cache_timeout, trading_days
+
+logger = logging.getLogger("root")
+
+
+def get_navs(codes: List[str]) -> Dict[str, Dict[str, np.ndarray]]:
+    """NAV histories of many funds, one cache round trip for the cached ones."""
+    found = cache.get_many([f"nav-{code}" for code in codes])
+    navs = {}
+    missing = {}
+    for code in codes:
+        nav = found.get(f"nav-{code}", None)
+        if nav is None:
+            nav = get_nav(code)
+            if nav is None:
+                continue
+            missing[f"nav-{code}"] = nav
+        navs[code] = nav
+    if missing:
+        cache.set_many(missing, fundprice_cache_timeout)
+    return navs
+
+
+def get_nav_matrix(codes: List[str], start: Optional[datetime.date] = None) -> pd.DataFrame:
+    """Cumulative NAV of the funds aligned on a date x fund matrix, cached for the day."""
+    key = "navmatrix-" + hashlib.md5(f"{sorted(codes)}-{start}-{datetime.date.today()}".encode("utf-8")).hexdigest()
+    matrix = cache.get(key, default=None)
+    if matrix is not None:
+        return matrix
+
+    navs = get_navs(codes)
+    matrix = pd.DataFrame({code: pd.Series(nav["cum"], index=nav["date"]) for code, nav in navs.items()})
+    matrix = matrix.sort_index()
+    if start is not None:
+        matrix = matrix[matrix.index >= np.datetime64(start)]
+    # funds trading on different calendars keep their last NAV on the other funds' days
+    matrix = matrix.ffill()
+    matrix = matrix[[code for code in codes if code in matrix.columns]]
+    cache.set(key, matrix, fundprice_cache_timeout)
+    return matrix
+
+
+def compare_funds(codes: List[str], start: Optional[datetime.date] = None, window: int = trading_days) -> Dict[str, Any]:
+    """Aligned NAV, rolling returns over window days and risk statistics of the funds, all on one matrix."""
+    if window < 1:
+        raise ValueError(f"rolling window must be at least 1, got {window}")
+    matrix = get_nav_matrix(codes, start)
+    M = matrix.to_numpy(dtype=np.float64)
+    if M.size == 0:
+        return {"codes": [], "dates": [], "nav": {}, "rolling": {}, "stats": {}, "corr": {}}
+
+    first = np.argmax(~np.isnan(M), axis=0)
+    base = M[first, np.arange(M.shape[1])]
+    normalized = M / base
+
+    returns = M[1:] / M[:-1] - 1
+    with np.errstate(invalid="ignore"):
+        vol = np.nanstd(returns, axis=0) * np.sqrt(trading_days)
+        total = normalized[-1] - 1
+        dates = matrix.index.to_numpy(dtype="datetime64[D]")
+        years = (dates[-1] - dates[first]).astype(np.float64) / 365.25
+        annual = np.where(years > 0, (1 + total) ** (1 / np.where(years > 0, years, 1)) - 1, np.nan)
+        drawdown = M / np.fmax.accumulate(M, axis=0) - 1
+    max_drawdown = np.nanmin(drawdown, axis=0)
+
+    # a window as long as the history leaves no rolling returns
+    window = min(window, len(M))
+    rolling = np.full_like(M, np.nan)
+    if window < len(M):
+        rolling[window:] = M[window:] / M[:-window] - 1
+
+    corr = pd.DataFrame(returns, columns=matrix.columns).corr(min_periods=20)
+
+    def show(a):
+        return [None if np.isnan(v) else round(float(v), 6) for v in a]
+
+    return {
+        "codes": list(matrix.columns),
+        "dates": [str(d) for d in matrix.index.to_numpy(dtype="datetime64[D]")],
+        "nav": {code: show(normalized[:, i]) for i, code in enumerate(matrix.columns)},
+        "rolling": {code: show(rolling[:, i]) for i, code in enumerate(matrix.columns)},
+        "stats": {
+            code: {
+                "total_return": show([total[i]])[0],
+                "annual_return": show([annual[i]])[0],
+                "volatility": show([vol[i]])[0],
+                "max_drawdown": show([max_drawdown[i]])[0],
+            } for i, code in enumerate(matrix.columns)
+        },
+        "corr": {code: show(corr[code].to_numpy()) for code in corr.columns},
+    }
@@ -0,0 +1,101 @@
+from typing import Any, Dict, List, Optional
+from dataclasses import asdict
+import logging
+import math
+from django.core.cache import cache
+from .api import Fund, FundPrice, get_fund_cache, get_fundprice_cache, get_rt_estimates
+
+logger = logging.getLogger("root")
+
+detail_fields = ["info", "holdings", "allocation", "price", "estimate"]
+# funds fetched from upstream in one request when they are not cached yet, the rest are reported missing
+fetch_limit = 5
+
+
+def json_safe(value):
+    """NaN, which upstream tables use for missing numbers, and infinity are not JSON; they become null."""
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    if isinstance(value, dict):
+        return {k: json_safe(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [json_safe(v) for v in value]
+    return value
+
+
+def fund_detail(fund: Fund, fundprice: Optional[FundPrice], estimate, now, fields: List[str]) -> Dict[str, Any]:
+    detail = {"code": fund.code}
+    if "info" in fields:
+        detail["info"] = {
+            "name": fund.name,
+            "type": fund.type,
+            "fee": fund.fee,
+            "manager": fund.manager,
+            "company": fund.company,
+            "scale": fund.scale,
+            "star": fund.star,
+            "recommend": fund.recommand,
+        }
+    if "holdings" in fields:
+        detail["holdings"] = {
+            "stock_season": fund.stock_season,
+            "stock": fund.stock,
+            "bond_season": fund.bond_season,
+            "bond": fund.bond,
+        }
+    if "allocation" in fields:
+        detail["allocation"] = {
+            "stock_share": fund.stock_share,
+            "bond_share": fund.bond_share,
+            "other_share": fund.other_share,
+        }
+    if "price" in fields:
+        detail["price"] = None
+        if fundprice is not None:
+            detail["price"] = asdict(fundprice)
+            detail["price"].pop("code")
+    if "estimate" in fields:
+        detail["estimate"] = None
+        if estimate is not None:
+            detail["estimate"] = {**asdict(estimate), "time": now}
+    return json_safe(detail)
+
+
+def get_fund_details(codes: List[str], fields: List[str]):
+    """
+    Details of many funds from the caches, falling back to the last good copies and fetching at most
+    fetch_limit funds that are not cached at all; returns (details, codes without any cached data).
+    """
+    keys = [f"fund-{code}" for code in codes] + [f"fund-{code}-last" for code in codes]
+    if "price" in fields:
+        keys += [f"fundprice-{code}" for code in codes] + [f"fundprice-{code}-last" for code in codes]
+    found = cache.get_many(keys)
+
+    funds = []
+    fundprices = {}
+    missing = []
+    fetched = 0
+    for code in codes:
+        fund = found.get(f"fund-{code}", None) or found.get(f"fund-{code}-last", None)
+        fundprice = found.get(f"fundprice-{code}", None) or found.get(f"fundprice-{code}-last", None)
+        if fund is None or ("price" in fields and fundprice is None):
+            if fetched < fetch_limit:
+                fetched += 1
+                fund = fund or get_fund_cache(code)
+                if fund is not None and "price" in fields and fundprice is None:
+                    fundprice = get_fundprice_cache(code)
+        if fund is None:
+            missing.append(code)
+            continue
+        funds.append(fund)
+        fundprices[code] = fundprice
+
+    now, estimates = None, {}
+    if "estimate" in fields and funds:
+        try:
+            now, estimates = get_rt_estimates(funds)
+        except Exception as e:
+            logger.error(f"error estimating {len(funds)} funds: {e}")
+
+    details = [fund_detail(fund, fundprices.get(fund.code), estimates.get(fund.code), now, fields) for fund in funds]
+    return details, missing
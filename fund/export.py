@@ -0,0 +1,221 @@
+from typing import Any, Dict, Iterable, List, Optional
+import datetime
+import json
+import logging
+import os
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from django.core.cache import cache
+from django.db.models import Count
+from .market import season_quarter
+from .models import FundHolding
+from .search import get_fund_universe, refresh_fund_universe
+
+logger = logging.getLogger("root")
+
+universe_schema = pa.schema([
+    ("code", pa.string()),
+    ("name", pa.string()),
+    ("type", pa.string()),
+    ("initials", pa.string()),
+])
+
+holdings_schema = pa.schema([
+    ("fundcode", pa.string()),
+    ("fundname", pa.string()),
+    ("stockcode", pa.string()),
+    ("stockname", pa.string()),
+    ("share", pa.float64()),
+    ("season", pa.string()),
+    ("year", pa.int16()),
+    ("quarter", pa.int8()),
+])
+
+nav_schema = pa.schema([
+    ("code", pa.string()),
+    ("date", pa.date32()),
+    ("unit", pa.float64()),
+    ("cum", pa.float64()),
+    ("rate", pa.float64()),
+])
+
+suffixes = {"parquet": "parquet", "arrow": "arrow"}
+
+
+class ChunkWriter(object):
+    """Writes record batches to a Parquet or Arrow IPC file as they come, renamed into place when closed."""
+
+    def __init__(self, path: str, schema: pa.Schema, fmt: str = "parquet"):
+        self.path = path
+        self.tmp = f"{path}.tmp"
+        self.schema = schema
+        self.rows = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if fmt == "parquet":
+            self.writer = pq.ParquetWriter(self.tmp, schema, compression="zstd")
+        else:
+            self.sink = pa.OSFile(self.tmp, "wb")
+            self.writer = pa.ipc.new_file(self.sink, schema)
+        self.fmt = fmt
+
+    def write(self, columns: Dict[str, Any]):
+        batch = pa.RecordBatch.from_pydict(columns, schema=self.schema)
+        if batch.num_rows == 0:
+            return
+        self.writer.write_batch(batch)
+        self.rows += batch.num_rows
+
+    def close(self) -> int:
+        self.writer.close()
+        if self.fmt != "parquet":
+            self.sink.close()
+        os.replace(self.tmp, self.path)
+        return self.rows
+
+    def abort(self):
+        try:
+            self.writer.close()
+            if self.fmt != "parquet":
+                self.sink.close()
+        finally:
+            if os.path.exists(self.tmp):
+                os.remove(self.tmp)
+
+
+def load_manifest(out: str) -> Dict[str, Any]:
+    try:
+        with open(os.path.join(out, "manifest.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(out: str, manifest: Dict[str, Any]):
+    path = os.path.join(out, "manifest.json")
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(f"{path}.tmp", path)
+
+
+def export_universe(out: str, fmt: str = "parquet") -> int:
+    """The whole fund universe, small enough to be rewritten every time."""
+    universe = get_fund_universe() or refresh_fund_universe()
+    if universe is None:
+        return 0
+    writer = ChunkWriter(os.path.join(out, f"universe.{suffixes[fmt]}"), universe_schema, fmt)
+    try:
+        rows = universe["rows"]
+        writer.write({name: [row[i] for row in rows] for i, name in enumerate(universe_schema.names)})
+    except Exception:
+        writer.abort()
+        raise
+    return writer.close()
+
+
+def export_holdings(out: str, manifest: Dict[str, Any], fmt: str = "parquet", chunk_size: int = 10000) -> Dict[str, int]:
+    """
+    One file per season from the recorded holdings. A season is rewritten only when its
+    row count changed since the last export, funds keep reporting into the latest seasons.
+    """
+    exported = manifest.setdefault("holdings", {})
+    counts = dict(FundHolding.objects.order_by().values("season").annotate(n=Count("id")).values_list("season", "n"))
+    written = {}
+    for season, n in sorted(counts.items()):
+        if exported.get(season) == n:
+            continue
+        quarter = season_quarter(season)
+        name = f"{quarter[0]}Q{quarter[1]}" if quarter else season.replace("/", "_")
+        writer = ChunkWriter(os.path.join(out, "holdings", f"{name}.{suffixes[fmt]}"), holdings_schema, fmt)
+        try:
+            rows = FundHolding.objects.filter(season=season).order_by("fundcode", "-share").values_list(
+                "fundcode", "fundname", "stockcode", "stockname", "share").iterator(chunk_size=chunk_size)
+            for chunk in chunked(rows, chunk_size):
+                columns = {schema_name: [row[i] for row in chunk] for i, schema_name in enumerate(holdings_schema.names[:5])}
+                columns["season"] = [season] * len(chunk)
+                columns["year"] = [quarter[0] if quarter else None] * len(chunk)
+                columns["quarter"] = [quarter[1] if quarter else None] * len(chunk)
+                writer.write(columns)
+        except Exception:
+            writer.abort()
+            raise
+        written[season] = writer.close()
+        exported[season] = n
+    return written
+
+
+def export_navs(out: str, manifest: Dict[str, Any], codes: List[str], fmt: str = "parquet", chunk_size: int = 200) -> Dict[str, int]:
+    """
+    NAV rows newer than each fund's last exported date, from the cached histories, into one file per run.
+    Funds are read chunk_size at a time, each chunk becomes a row group and is dropped before the next.
+    """
+    exported = manifest.setdefault("nav", {})
+    today = datetime.date.today().isoformat()
+    path = os.path.join(out, "nav", f"{today}.{suffixes[fmt]}")
+    if os.path.exists(path):
+        # a second run on the same day adds a part instead of replacing the first one
+        path = os.path.join(out, "nav", f"{today}-{datetime.datetime.now():%H%M%S}.{suffixes[fmt]}")
+    writer = ChunkWriter(path, nav_schema, fmt)
+    stats = {"funds": 0, "rows": 0, "uncached": 0}
+    watermarks = {}
+    try:
+        for chunk in chunked(codes, chunk_size):
+            found = cache.get_many([f"nav-{code}" for code in chunk])
+            parts = []
+            for code in chunk:
+                nav = found.get(f"nav-{code}", None)
+                if nav is None:
+                    stats["uncached"] += 1
+                    continue
+                since = exported.get(code, None)
+                mask = nav["date"] > np.datetime64(since) if since else np.ones(len(nav["date"]), dtype=bool)
+                if not mask.any():
+                    continue
+                parts.append((code, {name: nav[name][mask] for name in ("date", "unit", "cum", "rate")}))
+                watermarks[code] = str(nav["date"][mask].max())
+            if not parts:
+                continue
+            writer.write({
+                "code": np.concatenate([np.full(len(p["date"]), code, dtype=object) for code, p in parts]),
+                "date": np.concatenate([p["date"] for _, p in parts]),
+                "unit": np.concatenate([p["unit"] for _, p in parts]),
+                "cum": np.concatenate([p["cum"] for _, p in parts]),
+                "rate": np.concatenate([p["rate"] for _, p in parts]),
+            })
+            stats["funds"] += len(parts)
+            del found, parts
+    except Exception:
+        writer.abort()
+        raise
+    stats["rows"] = writer.rows
+    if writer.rows == 0:
+        writer.abort()
+    else:
+        writer.close()
+        exported.update(watermarks)
+    return stats
+
+
+def chunked(items: Iterable, size: int) -> Iterable[List]:
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def export_all(out: str, what: List[str], codes: Optional[List[str]] = None, fmt: str = "parquet") -> Dict[str, Any]:
+    manifest = load_manifest(out)
+    result = {}
+    if "universe" in what:
+        result["universe"] = export_universe(out, fmt)
+    if "holdings" in what:
+        result["holdings"] = export_holdings(out, manifest, fmt)
+        save_manifest(out, manifest)
+    if "nav" in what:
+        result["nav"] = export_navs(out, manifest, codes or [], fmt)
+        save_manifest(out, manifest)
+    return result
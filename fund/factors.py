@@ -0,0 +1,144 @@
+from typing import Any, Dict, List, Optional
+import datetime
+import json
+import logging
+import os
+import shutil
+import time
+import numpy as np
+from django.conf import settings
+
+logger = logging.getLogger("root")
+
+# publications kept besides the current one, a worker may still be mapping an older one
+keep_versions = 2
+
+
+def get_factor_dir() -> str:
+    return getattr(settings, "FUND_FACTOR_DIR", os.path.join(settings.BASE_DIR, "data", "factors"))
+
+
+class FactorTable(object):
+    """
+    Spot returns of the A, HK and US markets: one code array, sorted within each market's
+    segment, and the matching float array. Either built in memory or mapped from the refresher's files.
+    """
+
+    def __init__(self, codes: np.ndarray, values: np.ndarray, offsets: np.ndarray, bond_index: Optional[Dict[str, float]],
+                 version: Optional[datetime.datetime] = None, expires: float = 0):
+        self.codes = codes
+        self.values = values
+        self.offsets = offsets
+        self.bond_index = bond_index
+        self.version = version
+        self.expires = expires
+
+    @classmethod
+    def from_dicts(cls, tables: List[Optional[Dict[str, float]]], bond_index, version=None, expires: float = 0) -> "FactorTable":
+        codes = []
+        values = []
+        offsets = [0]
+        for table in tables:
+            table = table or {}
+            segment = np.array(list(table.keys()), dtype=str)
+            order = np.argsort(segment, kind="stable")
+            codes.append(segment[order])
+            values.append(np.fromiter(table.values(), dtype=np.float64, count=len(table))[order])
+            offsets.append(offsets[-1] + len(table))
+        return cls(np.concatenate(codes), np.concatenate(values), np.array(offsets, dtype=np.int64), bond_index, version, expires)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def segment(self, market: int):
+        begin, end = self.offsets[market], self.offsets[market + 1]
+        return self.codes[begin:end], self.values[begin:end]
+
+    def lookup(self, codes: List[str]):
+        """Spot return and market of each code, NaN and -1 when no market lists it; A before HK before US."""
+        query = np.array(codes, dtype=str)
+        prices = np.full(len(query), np.nan)
+        markets = np.full(len(query), -1, dtype=np.int64)
+        if len(query) == 0 or len(self.codes) == 0:
+            return prices, markets
+        # codes longer than the table's width cannot be in it, and must not match once truncated
+        fits = np.char.str_len(query) <= self.codes.dtype.itemsize // 4
+        query = query.astype(self.codes.dtype)
+        for m in range(len(self.offsets) - 1):
+            codes, values = self.segment(m)
+            if len(codes) == 0:
+                continue
+            pos = np.minimum(np.searchsorted(codes, query), len(codes) - 1)
+            hit = fits & (markets < 0) & (codes[pos] == query)
+            prices[hit] = values[pos[hit]]
+            markets[hit] = m
+        return prices, markets
+
+    def medians(self) -> np.ndarray:
+        """Median return of each market, zero for a market without data."""
+        medians = np.zeros(len(self.offsets) - 1)
+        for m in range(len(medians)):
+            _, values = self.segment(m)
+            if len(values):
+                medians[m] = np.nanmedian(values)
+        return medians
+
+
+def publish_factors(factors: FactorTable):
+    """Write the table as plain arrays into a new directory, then point the current link at it in one rename."""
+    factor_dir = get_factor_dir()
+    os.makedirs(factor_dir, exist_ok=True)
+    name = f"v{time.time_ns()}"
+    tmp = os.path.join(factor_dir, f".{name}")
+    os.makedirs(tmp)
+    np.save(os.path.join(tmp, "codes.npy"), factors.codes)
+    np.save(os.path.join(tmp, "values.npy"), factors.values)
+    np.save(os.path.join(tmp, "offsets.npy"), factors.offsets)
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump({
+            "version": factors.version.isoformat() if factors.version else None,
+            "expires": factors.expires,
+            "bond_index": factors.bond_index,
+        }, f)
+    os.rename(tmp, os.path.join(factor_dir, name))
+
+    link = os.path.join(factor_dir, f".current-{name}")
+    os.symlink(name, link)
+    os.replace(link, os.path.join(factor_dir, "current"))
+    logger.info(f"published {len(factors)} factors as {name}")
+
+    old = sorted(d for d in os.listdir(factor_dir) if d.startswith("v") and d != name)
+    for d in old[:-keep_versions]:
+        shutil.rmtree(os.path.join(factor_dir, d), ignore_errors=True)
+
+
+_mapped: Optional[FactorTable] = None
+_mapped_name: Optional[str] = None
+
+
+def load_factors(path: str) -> FactorTable:
+    with open(os.path.join(path, "meta.json")) as f:
+        meta: Dict[str, Any] = json.load(f)
+    version = datetime.datetime.fromisoformat(meta["version"]) if meta["version"] else None
+    return FactorTable(
+        np.load(os.path.join(path, "codes.npy"), mmap_mode="r"),
+        np.load(os.path.join(path, "values.npy"), mmap_mode="r"),
+        np.load(os.path.join(path, "offsets.npy")),
+        meta["bond_index"], version, meta["expires"],
+    )
+
+
+def get_mapped_factors() -> Optional[FactorTable]:
+    """The latest published table, mapped read-only; the pages are shared by every worker on the host."""
+    global _mapped, _mapped_name
+    factor_dir = get_factor_dir()
+    try:
+        name = os.readlink(os.path.join(factor_dir, "current"))
+        if name != _mapped_name:
+            _mapped = load_factors(os.path.join(factor_dir, name))
+            _mapped_name = name
+            logger.info(f"mapped {len(_mapped)} factors of {_mapped.version} from {name}")
+    except (OSError, ValueError) as e:
+        logger.debug(f"no published factors: {e}")
+        return None
+    return _mapped
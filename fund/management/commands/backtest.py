@@ -0,0 +1,49 @@
+import datetime
+import logging
+import pandas as pd
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from fund.api import get_fund_cache
+from fund.backtest import backtest, load_holdings, load_nav_rates, load_returns
+from fund.models import WatchFund
+
+logger = logging.getLogger("root")
+
+
+class Command(BaseCommand):
+    help = "Measure the real-time estimate against the actual daily NAV change over the recorded spot history"
+
+    def add_arguments(self, parser):
+        parser.add_argument("codes", nargs="*", help="fund codes, all watched funds by default")
+        parser.add_argument("--days", type=int, default=90, help="days to look back")
+        parser.add_argument("--output", help="write per fund statistics to this csv file")
+
+    def handle(self, *args, **options):
+        codes = options["codes"] or list(WatchFund.objects.values_list("fundcode", flat=True).distinct())
+        end = datetime.date.today()
+        start = end - datetime.timedelta(days=options["days"])
+
+        returns = load_returns(start, end)
+        if returns.empty:
+            self.stderr.write("no spot returns recorded in this period, is refresh_factors running?")
+            return
+        holdings = load_holdings(codes, start, end)
+        nav = load_nav_rates(codes, start, end)
+
+        # the current asset allocation is the best stock share we know of
+        stock_share = {}
+        for code in codes:
+            fund = get_fund_cache(code)
+            if fund is not None:
+                stock_share[code] = fund.stock_share
+        # the live estimate adds each fund's residual
+        found = cache.get_many([f"residual-{code}" for code in codes])
+        residual = pd.Series({code: found[f"residual-{code}"] for code in codes if f"residual-{code}" in found}, dtype=float)
+        result = backtest(returns, holdings, nav, pd.Series(stock_share, dtype=float) if stock_share else None, residual)
+
+        for name, value in result.summary.items():
+            self.stdout.write(f"{name}: {value}")
+        if options["output"]:
+            result.stats.to_csv(options["output"])
+        else:
+            self.stdout.write(result.stats.to_string())
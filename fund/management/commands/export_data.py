@@ -0,0 +1,46 @@
+import resource
+import time
+from django.core.management.base import BaseCommand
+from fund.export import export_all
+from fund.models import WatchFund
+from fund.search import get_fund_universe, refresh_fund_universe
+
+
+class Command(BaseCommand):
+    help = "Export the fund universe, holdings by season and NAV histories as Parquet or Arrow files, incrementally"
+
+    def add_arguments(self, parser):
+        parser.add_argument("out", help="output directory, its manifest.json records what was exported")
+        parser.add_argument("--what", default="universe,holdings,nav", help="comma separated: universe, holdings, nav")
+        parser.add_argument("--all", action="store_true", help="export the NAV of every cached fund of the market, not only watched ones")
+        parser.add_argument("--format", choices=["parquet", "arrow"], default="parquet", help="Parquet or Arrow IPC files")
+
+    def handle(self, *args, **options):
+        what = [w for w in options["what"].split(",") if w]
+        codes = None
+        if "nav" in what:
+            if options["all"]:
+                universe = get_fund_universe() or refresh_fund_universe()
+                if universe is None:
+                    self.stderr.write("failed to get the fund universe")
+                    return
+                codes = sorted(row[0] for row in universe["rows"])
+            else:
+                codes = sorted(set(WatchFund.objects.values_list("fundcode", flat=True)))
+
+        begin = time.perf_counter()
+        result = export_all(options["out"], what, codes, options["format"])
+        elapsed = time.perf_counter() - begin
+
+        if "universe" in result:
+            self.stdout.write(f"universe: {result['universe']} funds")
+        if "holdings" in result:
+            for season, rows in result["holdings"].items():
+                self.stdout.write(f"holdings {season}: {rows} rows")
+            if not result["holdings"]:
+                self.stdout.write("holdings: no new seasons")
+        if "nav" in result:
+            nav = result["nav"]
+            self.stdout.write(f"nav: {nav['rows']} new rows of {nav['funds']} funds, {nav['uncached']} funds not cached")
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        self.stdout.write(f"exported in {elapsed:.1f}s, peak rss {peak:.1f}MB")
@@ -0,0 +1,70 @@
+import json
+import os
+import subprocess
+import sys
+import time
+from django.core.management.base import BaseCommand
+
+# modules a serving worker should not load until an upstream fetch needs them
+heavy_modules = ["akshare", "bs4", "lxml", "py_mini_racer", "pypinyin", "pandas", "numpy"]
+
+child_script = """
+import json, resource, sys, time
+begin = time.perf_counter()
+import django
+django.setup()
+for module in sys.argv[2:]:
+    __import__(module)
+elapsed = time.perf_counter() - begin
+print(json.dumps({
+    "elapsed": elapsed,
+    "rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    "loaded": [m for m in json.loads(sys.argv[1]) if m in sys.modules],
+}))
+"""
+
+
+def parse_importtime(stderr: str):
+    """(cumulative us, package) of the top level imports reported by python -X importtime."""
+    found = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if name.startswith(" ") and not name.startswith("  "):
+            found.append((int(cumulative), name.strip()))
+    return found
+
+
+class Command(BaseCommand):
+    help = "Measure the startup time and memory of a fresh worker importing the given modules"
+
+    def add_arguments(self, parser):
+        parser.add_argument("modules", nargs="*", help="modules to import after django.setup(), the url conf by default")
+        parser.add_argument("--repeat", type=int, default=3, help="runs to take the best time of")
+        parser.add_argument("--top", type=int, default=10, help="slowest top level imports to list")
+
+    def handle(self, *args, **options):
+        modules = options["modules"] or ["fundviewer.urls"]
+        best = None
+        for _ in range(max(options["repeat"], 1)):
+            begin = time.perf_counter()
+            proc = subprocess.run(
+                [sys.executable, "-X", "importtime", "-c", child_script, json.dumps(heavy_modules)] + modules,
+                capture_output=True, text=True, env=os.environ.copy(),
+            )
+            wall = time.perf_counter() - begin
+            if proc.returncode != 0:
+                self.stderr.write(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "import failed")
+                return
+            result = json.loads(proc.stdout.strip().splitlines()[-1])
+            result["wall"] = wall
+            result["imports"] = parse_importtime(proc.stderr)
+            if best is None or result["elapsed"] < best["elapsed"]:
+                best = result
+
+        self.stdout.write(f"import {', '.join(modules)}: {best['elapsed']*1000:.0f}ms after interpreter start, "
+                          f"{best['wall']*1000:.0f}ms wall, peak rss {best['rss']/1024:.1f}MB")
+        self.stdout.write(f"heavy modules loaded: {', '.join(best['loaded']) or 'none'}")
+        for cumulative, name in sorted(best["imports"], reverse=True)[:options["top"]]:
+            self.stdout.write(f"{cumulative/1000:10.1f}ms  {name}")
@@ -0,0 +1,49 @@
+import datetime
+import time
+import logging
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.cache import cache
+from fund.api import get_rt_factor, get_rt_version, publish_rt_factors, refresh_index
+from fund.search import refresh_fund_universe
+from fund.series import refresh_series, update_residuals
+
+logger = logging.getLogger("root")
+
+
+class Command(BaseCommand):
+    help = "Keep the real-time factor tables, the index panel and the fund universe fresh, following the market sessions"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="refresh once and exit")
+
+    def handle(self, *args, **options):
+        # the tables expire on the market schedule, polling only refetches expired ones
+        poll = max(1, getattr(settings, "FUND_RT_INTERVAL", 60) // 6)
+        version = None
+        published_expires = 0
+        residual_day = None
+        while True:
+            try:
+                get_rt_factor()
+                if cache.get("index_fresh", default=None) is None:
+                    refresh_index()
+                # searches only read the cached universe, renew it before it expires
+                if cache.get("universe_fresh", default=None) is None:
+                    refresh_fund_universe()
+                if get_rt_version() != version or time.time() >= published_expires:
+                    try:
+                        published_expires = publish_rt_factors()
+                    except Exception as e:
+                        logger.error(f"publish factors error: {e}")
+                if get_rt_version() != version:
+                    version = get_rt_version()
+                    refresh_series()
+                if residual_day != datetime.date.today():
+                    residual_day = datetime.date.today()
+                    update_residuals()
+            except Exception as e:
+                logger.error(f"refresh factors error: {e}")
+            if options["once"]:
+                break
+            time.sleep(poll)
@@ -0,0 +1,57 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import logging
+import resource
+import time
+import django
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from fund.api import ak, market_tables, load_table, get_fund_info, get_fund_extra, fetch_a_stocks, fetch_h_stocks, fetch_m_stocks, refresh_index
+from fund.upstream import call_key
+
+logger = logging.getLogger("root")
+
+
+def refresh(code: str, threads: int):
+    """Runs in a worker process: the cold whole-market loads of a page view and a factor refresh, all at once."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    begin = time.perf_counter()
+    jobs = [lambda: get_fund_info(code), lambda: get_fund_extra(code), fetch_a_stocks, fetch_h_stocks, fetch_m_stocks, refresh_index]
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for future in [executor.submit(job) for job in jobs]:
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"refresh error: {e}")
+    return rss, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, time.perf_counter() - begin
+
+
+class Command(BaseCommand):
+    help = "Compare full and cut down whole-market tables, and the peak RSS of workers refreshing them concurrently"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--code", default="000001", help="fund looked up in the fund tables")
+        parser.add_argument("--workers", type=int, default=4, help="worker processes refreshing at once")
+        parser.add_argument("--threads", type=int, default=6, help="concurrent loads inside each worker")
+        parser.add_argument("--skip-sizes", action="store_true", help="only run the concurrent refresh")
+
+    def handle(self, *args, **options):
+        if not options["skip_sizes"]:
+            for name, (columns, index) in market_tables.items():
+                try:
+                    full = getattr(ak, name)()
+                    full_size = full.memory_usage(deep=True).sum()
+                    del full
+                    compact = load_table(name, columns, index)
+                    compact_size = compact.memory_usage(deep=True).sum()
+                except Exception as e:
+                    self.stderr.write(f"{name}: {e}")
+                    continue
+                self.stdout.write(f"{name:24s} {len(compact):6d} rows  full {full_size/2**20:8.2f}MB  kept {compact_size/2**20:8.2f}MB")
+
+        # drop the shared results so every worker starts cold
+        cache.delete_many([f"upstream-result-{call_key(load_table, (name, columns, index), {})}" for name, (columns, index) in market_tables.items()])
+        with ProcessPoolExecutor(max_workers=options["workers"], initializer=django.setup) as executor:
+            futures = [executor.submit(refresh, options["code"], options["threads"]) for _ in range(options["workers"])]
+            for i, future in enumerate(futures):
+                before, peak, elapsed = future.result()
+                self.stdout.write(f"worker {i}: peak rss {peak/1024:.1f}MB ({(peak-before)/1024:+.1f}MB during refresh), {elapsed:.2f}s")
@@ -0,0 +1,95 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import time
+import logging
+import django
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from fund.api import get_fund, get_nav, get_price, refresh_fund, fund_timeout, fundprice_cache_timeout, stale_cache_timeout
+from fund.models import FundHolding, WatchFund
+from fund.search import get_fund_universe, refresh_fund_universe
+
+logger = logging.getLogger("root")
+
+
+def fetch(code: str, need_fund: bool, need_price: bool):
+    """Runs in a worker process: upstream I/O and parsing, the parent writes the cache."""
+    fund = None
+    if need_fund:
+        # an expired fund only refetches the parts that may have changed
+        last = cache.get(f"fund-{code}-last", default=None)
+        fund = refresh_fund(last) if last else get_fund(code)
+    nav = get_nav(code) if need_price else None
+    fundprice = get_price(code, nav) if nav else None
+    return code, fund, nav, fundprice
+
+
+class Command(BaseCommand):
+    help = "Fill the fund and fund price cache for all watched funds, or the whole fund universe"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true", help="warm every fund of the market, not only watched ones")
+        parser.add_argument("--workers", type=int, default=4, help="worker processes, also the number of funds fetched at once")
+        parser.add_argument("--force", action="store_true", help="refetch funds that are already cached")
+
+    def handle(self, *args, **options):
+        if options["all"]:
+            universe = get_fund_universe() or refresh_fund_universe()
+            if universe is None:
+                self.stderr.write("failed to get the fund universe")
+                return
+            codes = sorted(row[0] for row in universe["rows"])
+        else:
+            codes = sorted(set(WatchFund.objects.values_list("fundcode", flat=True)))
+
+        # whatever is cached already is done, an interrupted run picks up where it stopped
+        todo = []
+        for i in range(0, len(codes), 500):
+            chunk = codes[i:i+500]
+            found = {} if options["force"] else cache.get_many([f"fund-{c}" for c in chunk] + [f"fundprice-{c}" for c in chunk])
+            cached = set(found)
+            for code in chunk:
+                if f"fund-{code}" in found:
+                    FundHolding.update_fund(found[f"fund-{code}"])
+                need_fund = f"fund-{code}" not in cached
+                need_price = f"fundprice-{code}" not in cached
+                if need_fund or need_price:
+                    todo.append((code, need_fund, need_price))
+        self.stdout.write(f"{len(codes)} funds, {len(codes) - len(todo)} already cached, {len(todo)} to fetch")
+
+        begin = time.perf_counter()
+        done = failed = 0
+        with ProcessPoolExecutor(max_workers=options["workers"], initializer=django.setup) as executor:
+            futures = [executor.submit(fetch, *t) for t in todo]
+            try:
+                for future in as_completed(futures):
+                    done += 1
+                    try:
+                        code, fund, nav, fundprice = future.result()
+                    except Exception as e:
+                        logger.error(f"warm fund error: {e}")
+                        fund = nav = fundprice = None
+                    if fund:
+                        cache.set(f"fund-{code}", fund, fund_timeout(fund))
+                        cache.set(f"fund-{code}-last", fund, stale_cache_timeout)
+                        FundHolding.update_fund(fund)
+                    if nav:
+                        cache.set(f"nav-{code}", nav, fundprice_cache_timeout)
+                    if fundprice:
+                        cache.set(f"fundprice-{code}", fundprice, fundprice_cache_timeout)
+                        cache.set(f"fundprice-{code}-last", fundprice, stale_cache_timeout)
+                    if fund is None and fundprice is None:
+                        failed += 1
+
+                    if done % 20 == 0 or done == len(todo):
+                        elapsed = time.perf_counter() - begin
+                        rate = done / elapsed if elapsed > 0 else 0
+                        eta = (len(todo) - done) / rate if rate > 0 else 0
+                        self.stdout.write(f"{done}/{len(todo)} funds, {failed} failed, {rate:.2f} funds/s, eta {eta:.0f}s")
+            except KeyboardInterrupt:
+                for future in futures:
+                    future.cancel()
+                self.stdout.write(f"interrupted after {done} funds, run again to resume")
+                raise
+
+        elapsed = time.perf_counter() - begin
+        self.stdout.write(f"warmed {done - failed} funds in {elapsed:.1f}s, {failed} failed")
@@ -0,0 +1,125 @@
+from typing import List, Optional, Tuple
+from zoneinfo import ZoneInfo
+import bisect
+import datetime
+import logging
+import re
+from django.conf import settings
+from django.core.cache import cache
+from .upstream import ak, call
+
+logger = logging.getLogger("root")
+
+# trading sessions in local exchange time
+MARKETS = {
+    "a": {
+        "tz": ZoneInfo("Asia/Shanghai"),
+        "sessions": [(datetime.time(9, 30), datetime.time(11, 30)), (datetime.time(13, 0), datetime.time(15, 0))],
+    },
+    "h": {
+        "tz": ZoneInfo("Asia/Hong_Kong"),
+        "sessions": [(datetime.time(9, 30), datetime.time(12, 0)), (datetime.time(13, 0), datetime.time(16, 0))],
+    },
+    "m": {
+        "tz": ZoneInfo("America/New_York"),
+        "sessions": [(datetime.time(9, 30), datetime.time(16, 0))],
+    },
+}
+
+# keep refreshing a little after the close so the closing prices are picked up
+close_delay = datetime.timedelta(minutes=5)
+max_freeze = 86400 * 7
+# a failed trade calendar fetch is retried after this many seconds, the last good calendar is used meanwhile
+trade_dates_retry = 300
+
+
+def get_trade_dates(market: str) -> Optional[List[datetime.date]]:
+    """Sorted trading days of a market, None when only weekdays are known."""
+    if market != "a":
+        return None
+    trade_dates = cache.get("trade_dates_a", default=None)
+    if trade_dates is None:
+        try:
+            df = call(ak.tool_trade_date_hist_sina, result_ttl=3600)
+            trade_dates = sorted(df["trade_date"])
+            cache.set("trade_dates_a", trade_dates, 86400 * 7)
+            cache.set("trade_dates_a-last", trade_dates, None)
+        except Exception as e:
+            logger.error(f"get trade dates error: {e}, retrying in {trade_dates_retry}s")
+            # an empty list stands for no calendar until the retry
+            trade_dates = cache.get("trade_dates_a-last", default=None) or []
+            cache.set("trade_dates_a", trade_dates, trade_dates_retry)
+    return trade_dates or None
+
+
+def is_trade_day(market: str, day: datetime.date) -> bool:
+    trade_dates = get_trade_dates(market)
+    if trade_dates is None or day > trade_dates[-1]:
+        return day.weekday() < 5
+    i = bisect.bisect_left(trade_dates, day)
+    return i < len(trade_dates) and trade_dates[i] == day
+
+
+def next_refresh(market: str, now: Optional[datetime.datetime] = None) -> datetime.datetime:
+    """Start of the current session (when trading) or of the next one, as aware datetime."""
+    m = MARKETS[market]
+    tz = m["tz"]
+    now = (now or datetime.datetime.now(datetime.timezone.utc)).astimezone(tz)
+    day = now.date()
+    for _ in range(30):
+        if is_trade_day(market, day):
+            for start, end in m["sessions"]:
+                begin = datetime.datetime.combine(day, start, tzinfo=tz)
+                finish = datetime.datetime.combine(day, end, tzinfo=tz) + close_delay
+                if now < finish:
+                    return begin
+        day += datetime.timedelta(days=1)
+    return now + datetime.timedelta(seconds=max_freeze)
+
+
+def is_open(market: str, now: Optional[datetime.datetime] = None) -> bool:
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    return next_refresh(market, now) <= now
+
+
+def refresh_timeout(market: str, now: Optional[datetime.datetime] = None) -> int:
+    """Cache timeout of a market's real-time data: short while trading, frozen until the next session otherwise."""
+    interval = getattr(settings, "FUND_RT_INTERVAL", 60)
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    wait = (next_refresh(market, now) - now).total_seconds()
+    if wait <= 0:
+        return interval
+    return int(min(max(wait, interval), max_freeze))
+
+
+# holdings of a quarter are published some time after the quarter ends
+disclose_delay = datetime.timedelta(days=20)
+
+
+def season_quarter(season: Optional[str]) -> Optional[Tuple[int, int]]:
+    """(year, quarter) of a holdings season such as `2023年2季度股票投资明细`."""
+    m = re.match(r"(\d{4})年(\d)季度", season or "")
+    if m is None:
+        return None
+    return int(m.group(1)), int(m.group(2))
+
+
+def quarter_end(year: int, quarter: int) -> datetime.date:
+    if quarter == 4:
+        return datetime.date(year, 12, 31)
+    return datetime.date(year, quarter * 3 + 1, 1) - datetime.timedelta(days=1)
+
+
+def disclosed_quarter(day: datetime.date) -> Tuple[int, int]:
+    """The latest quarter whose holdings should be published by the given day."""
+    year, quarter = day.year, (day.month - 1) // 3 + 1
+    while quarter_end(year, quarter) + disclose_delay > day:
+        year, quarter = (year, quarter - 1) if quarter > 1 else (year - 1, 4)
+    return year, quarter
+
+
+def next_disclosure(day: datetime.date) -> datetime.date:
+    """The day the holdings of the quarter after the disclosed one are due."""
+    year, quarter = disclosed_quarter(day)
+    year, quarter = (year, quarter + 1) if quarter < 4 else (year + 1, 1)
+    return quarter_end(year, quarter) + disclose_delay
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.3 on 2026-10-19 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fund', '0002_watchfund_fundname'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='watchfund',
+            name='position',
+            field=models.FloatField(default=0),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.3 on 2026-10-19 11:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fund', '0003_watchfund_position'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FundHolding',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fundcode', models.CharField(max_length=20)),
+                ('fundname', models.CharField(max_length=100, null=True)),
+                ('stockcode', models.CharField(max_length=20)),
+                ('stockname', models.CharField(max_length=100, null=True)),
+                ('share', models.FloatField()),
+                ('season', models.CharField(max_length=50)),
+                ('latest', models.BooleanField(default=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['stockcode', 'latest'], name='fund_fundho_stockco_d232b0_idx'), models.Index(fields=['fundcode', 'season'], name='fund_fundho_fundcod_d81030_idx')],
+            },
+        ),
+    ]
@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, transaction
 
 # Create your models here.
 
@@ -7,6 +7,83 @@ class WatchFund(models.Model):
     username = models.CharField(max_length=150)
     fundcode = models.CharField(max_length=20)
     fundname = models.CharField(max_length=100, null=True)
+    # amount held, 0 when not entered
+    position = models.FloatField(default=0)
 
     def __str__(self):
         return self.username + ":" + self.fundcode
+
+
+class FundHolding(models.Model):
+    fundcode = models.CharField(max_length=20)
+    fundname = models.CharField(max_length=100, null=True)
+    stockcode = models.CharField(max_length=20)
+    stockname = models.CharField(max_length=100, null=True)
+    share = models.FloatField()
+    season = models.CharField(max_length=50)
+    # holdings of the fund's most recent season
+    latest = models.BooleanField(default=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["stockcode", "latest"]),
+            models.Index(fields=["fundcode", "season"]),
+        ]
+
+    def __str__(self):
+        return self.fundcode + ":" + self.stockcode
+
+    @classmethod
+    def update_fund(cls, fund):
+        """Record a fund's stock holdings, only touching the table when a new season shows up."""
+        season = fund.stock_season
+        if season is None:
+            return
+        if cls.objects.filter(fundcode=fund.code, season=season, latest=True).exists():
+            return
+        with transaction.atomic():
+            cls.objects.filter(fundcode=fund.code, latest=True).update(latest=False)
+            cls.objects.filter(fundcode=fund.code, season=season).delete()
+            cls.objects.bulk_create([
+                cls(fundcode=fund.code, fundname=fund.name, stockcode=s["code"], stockname=s["name"], share=s["share"], season=season)
+                for s in fund.stock
+            ])
+
+    @classmethod
+    def season_diff(cls, fundcode: str):
+        """Stock holdings of the fund's latest season against the season before, largest changes first."""
+        seasons = list(cls.objects.filter(fundcode=fundcode).values_list("season", flat=True).distinct().order_by("-season")[:2])
+        if len(seasons) < 2:
+            return None
+        season, previous = seasons
+        rows = cls.objects.filter(fundcode=fundcode, season__in=seasons).values_list("season", "stockcode", "stockname", "share")
+        current = {}
+        before = {}
+        names = {}
+        for row_season, stockcode, stockname, share in rows:
+            (current if row_season == season else before)[stockcode] = share
+            names[stockcode] = stockname
+        changes = []
+        for stockcode in current.keys() | before.keys():
+            share = current.get(stockcode, 0)
+            previous_share = before.get(stockcode, 0)
+            if stockcode not in before:
+                status = "新进"
+            elif stockcode not in current:
+                status = "退出"
+            elif share > previous_share:
+                status = "增持"
+            elif share < previous_share:
+                status = "减持"
+            else:
+                status = "不变"
+            changes.append({
+                "code": stockcode,
+                "name": names[stockcode],
+                "share": share,
+                "previous_share": previous_share,
+                "change": round(share - previous_share, 2),
+                "status": status,
+            })
+        changes.sort(key=lambda c: -abs(c["change"]))
+        return {"season": season, "previous": previous, "changes": changes}
@@ -0,0 +1,124 @@
+from typing import Any, Dict, List, Optional, Tuple
+from dataclasses import dataclass, field
+import logging
+import numpy as np
+import pandas as pd
+from django.core.cache import cache
+from .api import Fund, get_fund_cache, get_rt_prices, fund_cache_timeout
+
+logger = logging.getLogger("root")
+
+
+@dataclass
+class Portfolio(object):
+    funds: List[Dict[str, Any]] = field(default_factory=list)
+    exposure: List[Dict[str, Any]] = field(default_factory=list)
+    total_position: float = 0
+    stock_share: float = 0
+    bond_share: float = 0
+    rt_rate: Optional[float] = None
+    rt_time: Optional[str] = None
+
+    @property
+    def other_share(self) -> float:
+        return 1 - self.stock_share - self.bond_share
+
+    @property
+    def show_stock_share(self):
+        return f"{self.stock_share*100:.2f}"
+
+    @property
+    def show_bond_share(self):
+        return f"{self.bond_share*100:.2f}"
+
+    @property
+    def show_other_share(self):
+        return f"{self.other_share*100:.2f}"
+
+    @property
+    def show_rt_rate(self):
+        return f"{self.rt_rate*100:.2f}"
+
+
+def get_holdings_vectors(funds: List[Fund]) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Stock codes, names and weights (fraction of the fund) of each fund, cached per holdings season."""
+    keys = [f"holdings-{fund.code}-{fund.stock_season}" for fund in funds]
+    found = cache.get_many(keys)
+    missing = {}
+    vectors = []
+    for key, fund in zip(keys, funds):
+        vector = found.get(key, None)
+        if vector is None:
+            codes = np.array([s["code"] for s in fund.stock], dtype=object)
+            names = np.array([s["name"] for s in fund.stock], dtype=object)
+            weights = np.array([s["share"] for s in fund.stock], dtype=np.float64) / 100
+            vector = (codes, names, weights)
+            missing[key] = vector
+        vectors.append(vector)
+    if missing:
+        cache.set_many(missing, fund_cache_timeout)
+    return vectors
+
+
+def get_portfolio(watch_funds: List[Tuple[str, str, float]]) -> Portfolio:
+    """
+    Look-through exposure of (code, name, position) watch funds.
+    Funds are weighted by position when any is entered, equally otherwise.
+    """
+    portfolio = Portfolio()
+    funds = []
+    for code, name, position in watch_funds:
+        fund = get_fund_cache(code)
+        if fund is not None:
+            funds.append((fund, name, position or 0))
+    if not funds:
+        return portfolio
+
+    positions = np.array([p for _, _, p in funds], dtype=np.float64)
+    portfolio.total_position = float(positions.sum())
+    if portfolio.total_position > 0:
+        fund_weights = positions / portfolio.total_position
+    else:
+        fund_weights = np.full(len(funds), 1 / len(funds))
+
+    portfolio.stock_share = float(np.dot(fund_weights, [f.stock_share for f, _, _ in funds]))
+    portfolio.bond_share = float(np.dot(fund_weights, [f.bond_share for f, _, _ in funds]))
+
+    now, estimates = get_rt_prices([f for f, _, _ in funds])
+    rates = np.array([estimates.get(f.code, np.nan) for f, _, _ in funds], dtype=np.float64)
+    priced = ~np.isnan(rates)
+    if priced.any() and fund_weights[priced].sum() > 0:
+        portfolio.rt_rate = float(np.dot(fund_weights[priced], rates[priced]) / fund_weights[priced].sum())
+        portfolio.rt_time = now.strftime("%H:%M") if now else None
+
+    for (fund, name, position), weight, rate in zip(funds, fund_weights, rates):
+        portfolio.funds.append({
+            "code": fund.code,
+            "name": name or fund.name,
+            "position": position,
+            "weight": round(weight * 100, 2),
+            "rt_rate": "---" if np.isnan(rate) else round(rate * 100, 2),
+        })
+
+    # one long table of (stock, weight in portfolio), then a group-by on the stock code
+    vectors = get_holdings_vectors([f for f, _, _ in funds])
+    codes = np.concatenate([v[0] for v in vectors])
+    if len(codes) == 0:
+        return portfolio
+    names = np.concatenate([v[1] for v in vectors])
+    weights = np.concatenate([v[2] * w for v, w in zip(vectors, fund_weights)])
+
+    inverse, stock_index = pd.factorize(codes)
+    exposure = np.bincount(inverse, weights=weights, minlength=len(stock_index))
+    fund_count = np.bincount(inverse, minlength=len(stock_index))
+    _, first = np.unique(inverse, return_index=True)
+
+    for i in np.argsort(-exposure):
+        portfolio.exposure.append({
+            "code": stock_index[i],
+            "name": names[first[i]],
+            "share": round(exposure[i] * 100, 2),
+            "funds": int(fund_count[i]),
+        })
+    logger.debug(f"portfolio of {len(funds)} funds, {len(stock_index)} stocks")
+    return portfolio
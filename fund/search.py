@@ -0,0 +1,112 @@
+from typing import Any, Dict, List, Optional
+import bisect
+import datetime
+import logging
+import time
+from django.core.cache import cache
+from .upstream import ak, call
+
+logger = logging.getLogger("root")
+
+universe_cache_timeout = 86400
+# the refresher downloads the universe again after this many seconds, well before it expires
+universe_refresh = 43200
+# and retries a failed download after this many
+universe_retry = 600
+# the last good universe, served while upstream is unavailable
+universe_stale_timeout = 86400 * 60
+# how often a worker checks whether the universe was refreshed
+index_check_interval = 60
+
+
+def get_initials(name: str) -> str:
+    # pypinyin loads its dictionaries on import, only the universe refresh needs them
+    from pypinyin import lazy_pinyin, Style
+    return "".join(lazy_pinyin(name, style=Style.FIRST_LETTER)).lower()
+
+
+def refresh_fund_universe() -> Optional[Dict[str, Any]]:
+    """Download all funds of the market, falling back to the last good universe when upstream fails."""
+    try:
+        df = call(ak.fund_name_em, result_ttl=600)
+        # missing names and types are NaN, which neither sorts with strings nor goes into JSON
+        df = df.fillna({"基金简称": "", "基金类型": ""})
+        rows = []
+        for code, name, fund_type, initials in zip(df["基金代码"], df["基金简称"], df["基金类型"], df["拼音缩写"]):
+            initials = initials.lower() if isinstance(initials, str) and initials else get_initials(name)
+            rows.append((code, name, fund_type, initials))
+    except Exception as e:
+        logger.error(f"get fund universe error: {e}, retrying in {universe_retry}s")
+        cache.set("universe_fresh", False, universe_retry)
+        return cache.get("fund-universe-last", default=None)
+    universe = {"version": datetime.datetime.now(), "rows": rows}
+    cache.set("fund-universe", universe, universe_cache_timeout)
+    cache.set_many({"fund-universe-last": universe, "fund-universe-version": universe["version"]}, universe_stale_timeout)
+    cache.set("universe_fresh", True, universe_refresh)
+    logger.info(f"refreshed fund universe of {len(rows)} funds")
+    return universe
+
+
+def get_fund_universe() -> Optional[Dict[str, Any]]:
+    """All funds of the market as (code, name, type, pinyin initials), with a version stamp; only reads the cache."""
+    found = cache.get_many(["fund-universe", "fund-universe-last"])
+    return found.get("fund-universe", None) or found.get("fund-universe-last", None)
+
+
+class SearchIndex(object):
+    """Sorted (key, row) arrays over code, pinyin initials and name, a prefix is one bisect away."""
+
+    def __init__(self, universe: Dict[str, Any]):
+        self.version = universe["version"]
+        self.rows = universe["rows"]
+        self.keys = []
+        for col in (0, 3, 1):
+            pairs = sorted((row[col].lower(), i) for i, row in enumerate(self.rows))
+            self.keys.append(([k for k, _ in pairs], [i for _, i in pairs]))
+
+    def search(self, q: str, limit: int = 10) -> List[Dict[str, str]]:
+        q = q.strip().lower()
+        if not q:
+            return []
+        found = []
+        seen = set()
+        for keys, rows in self.keys:
+            i = bisect.bisect_left(keys, q)
+            while i < len(keys) and keys[i].startswith(q) and len(found) < limit:
+                if rows[i] not in seen:
+                    seen.add(rows[i])
+                    code, name, fund_type, _ = self.rows[rows[i]]
+                    found.append({"code": code, "name": name, "type": fund_type})
+                i += 1
+            if len(found) >= limit:
+                break
+        return found
+
+
+_index: Optional[SearchIndex] = None
+_index_checked = 0.0
+
+
+def get_search_index() -> Optional[SearchIndex]:
+    """The worker's search index, rebuilt when another worker refreshed the universe."""
+    global _index, _index_checked
+    now = time.monotonic()
+    if _index is not None and now - _index_checked < index_check_interval:
+        return _index
+    _index_checked = now
+
+    version = cache.get("fund-universe-version", default=None)
+    if _index is not None and version == _index.version:
+        return _index
+    universe = get_fund_universe()
+    if universe is not None:
+        _index = SearchIndex(universe)
+        logger.info(f"built fund search index of {len(_index.rows)} funds")
+    return _index
+
+
+def search_funds(q: str, limit: int = 10) -> List[Dict[str, str]]:
+    index = get_search_index()
+    if index is None:
+        return []
+    return index.search(q, limit)
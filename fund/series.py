@@ -0,0 +1,154 @@
+from typing import Dict, Optional
+import datetime
+import logging
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from .api import get_fund_cache, get_nav_cache, get_rt_factor, precompute_estimates
+from .models import WatchFund
+
+logger = logging.getLogger("root")
+
+# one entry per day, columnar:
+#   time:   datetime64[s] array of the factor refreshes, shape (T,)
+#   codes:  fund codes, one column each
+#   index:  code -> column
+#   values: float32 estimates, shape (T, N), NaN where a fund was not watched yet
+
+
+def series_key(day: datetime.date) -> str:
+    return f"series-{day.isoformat()}"
+
+
+def append_series(now: datetime.datetime, estimates: Dict[str, float]):
+    key = series_key(now.date())
+    retention = getattr(settings, "FUND_SERIES_RETENTION", 7)
+
+    series = cache.get(key, default=None)
+    if series is None:
+        series = {
+            "time": np.empty(0, dtype="datetime64[s]"),
+            "codes": [],
+            "index": {},
+            "values": np.empty((0, 0), dtype=np.float32),
+        }
+    t = np.datetime64(now, "s")
+    if len(series["time"]) > 0 and series["time"][-1] >= t:
+        return
+
+    values = series["values"]
+    new_codes = [code for code in estimates if code not in series["index"]]
+    if new_codes:
+        for code in new_codes:
+            series["index"][code] = len(series["codes"])
+            series["codes"].append(code)
+        pad = np.full((values.shape[0], len(new_codes)), np.nan, dtype=np.float32)
+        values = np.hstack([values, pad])
+
+    row = np.full((1, len(series["codes"])), np.nan, dtype=np.float32)
+    for code, rate in estimates.items():
+        row[0, series["index"][code]] = rate
+    series["values"] = np.vstack([values, row])
+    series["time"] = np.append(series["time"], t)
+
+    cache.set(key, series, 86400 * retention)
+
+
+def get_series(code: str, day: Optional[datetime.date] = None):
+    """(times, estimates) of a fund over a day, None when nothing was recorded."""
+    day = day or datetime.date.today()
+    series = cache.get(series_key(day), default=None)
+    if series is None or code not in series["index"]:
+        return None
+    column = series["values"][:, series["index"][code]]
+    mask = ~np.isnan(column)
+    residual = cache.get(f"residual-{code}", default=0)
+    return series["time"][mask], column[mask] + residual
+
+
+def refresh_series():
+    """Estimate all watched funds at once, store and record them, with the spot returns behind them."""
+    now, a_stocks, h_stocks, m_stocks, _ = get_rt_factor()
+    if now is not None:
+        append_spot(now, a_stocks, h_stocks, m_stocks)
+
+    codes = WatchFund.objects.values_list("fundcode", flat=True).distinct()
+    funds = [fund for fund in (get_fund_cache(code) for code in codes) if fund is not None]
+    now, estimates = precompute_estimates(funds)
+    if now is None or not estimates:
+        return
+    # recorded without the residual correction, which is learnt from these records
+    append_series(now, {code: e.rate - e.residual for code, e in estimates.items()})
+    logger.info(f"recorded {len(estimates)} estimates at {now}")
+
+
+def spot_key(day: datetime.date) -> str:
+    return f"spot-{day.isoformat()}"
+
+
+def append_spot(now: datetime.datetime, *tables: Optional[Dict[str, float]]):
+    """Keep the day's latest spot returns, the last refresh of a day holds the close."""
+    retention = getattr(settings, "FUND_SPOT_RETENTION", 400)
+    merged = {}
+    for table in tables:
+        if table:
+            merged.update(table)
+    if not merged:
+        return
+    spot = {
+        "codes": np.array(list(merged.keys())),
+        "values": np.array(list(merged.values()), dtype=np.float32),
+    }
+    cache.set(spot_key(now.date()), spot, 86400 * retention)
+
+
+def get_spots(days) -> Dict[datetime.date, Dict[str, np.ndarray]]:
+    """Stored daily spot returns of the given days, missing days are left out."""
+    keys = {spot_key(day): day for day in days}
+    found = cache.get_many(list(keys))
+    return {keys[key]: spot for key, spot in found.items()}
+
+
+# days of history a residual needs before it is trusted fully, fewer days shrink it towards zero
+residual_shrink = 5
+
+
+def update_residuals():
+    """Mean gap between each fund's closing raw estimate and its actual NAV change over the recorded days."""
+    retention = getattr(settings, "FUND_SERIES_RETENTION", 7)
+    today = datetime.date.today()
+    days = [today - datetime.timedelta(days=i) for i in range(1, retention + 1)]
+    found = cache.get_many([series_key(day) for day in days])
+
+    closing = {}
+    for day in days:
+        series = found.get(series_key(day), None)
+        if series is None or len(series["time"]) == 0:
+            continue
+        values = series["values"]
+        # last recorded estimate of each fund that day
+        valid = ~np.isnan(values)
+        last = values.shape[0] - 1 - np.argmax(valid[::-1], axis=0)
+        for code, i in series["index"].items():
+            if valid[:, i].any():
+                closing.setdefault(code, {})[np.datetime64(day, "D")] = float(values[last[i], i])
+
+    residuals = {}
+    for code, estimates in closing.items():
+        nav = get_nav_cache(code)
+        if nav is None:
+            continue
+        days_estimated = np.array(list(estimates.keys()))
+        pos = np.searchsorted(nav["date"], days_estimated)
+        pos = np.minimum(pos, len(nav["date"]) - 1)
+        hit = nav["date"][pos] == days_estimated
+        if not hit.any():
+            continue
+        gaps = nav["rate"][pos[hit]] - np.array(list(estimates.values()))[hit]
+        gaps = gaps[~np.isnan(gaps)]
+        if len(gaps) == 0:
+            continue
+        residuals[f"residual-{code}"] = float(gaps.mean() * len(gaps) / (len(gaps) + residual_shrink))
+    if residuals:
+        cache.set_many(residuals, 86400 * 2)
+    logger.info(f"updated estimate residuals of {len(residuals)} funds")
@@ -0,0 +1,278 @@
+from typing import Any, Callable, Dict, Optional, Union
+import hashlib
+import importlib
+import logging
+import threading
+import time
+import requests
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger("root")
+
+
+class LazyModule(object):
+    """Stands in for a module that is only imported on first attribute access."""
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr: str):
+        if self._module is None:
+            begin = time.perf_counter()
+            self._module = importlib.import_module(self._name)
+            logger.info(f"imported {self._name} in {time.perf_counter() - begin:.2f}s")
+        return getattr(self._module, attr)
+
+
+# akshare pulls in a large module tree, workers that only serve cached pages never need it
+ak = LazyModule("akshare")
+
+# how long a worker holds the fetch lock before others stop waiting for it
+lock_timeout = 60
+# how often a waiting worker looks for the shared result
+poll_interval = 0.2
+
+# upstream calls per second of each source, shared by all workers
+default_rates = {"eastmoney": 10, "sina": 2, "chinabond": 2, "jisilu": 2, "other": 5}
+# longest a call waits for the rate limit before it is rejected
+rate_wait = 10
+# failures within breaker_window seconds that open a source's breaker
+breaker_threshold = 5
+breaker_window = 60
+# seconds an open breaker rejects calls before one probe call is let through
+breaker_cooldown = 30
+# errors that mean the source is unhealthy, not that the request was bad
+failure_errors = (requests.RequestException, ConnectionError, TimeoutError)
+
+sources = {
+    "fund_rating_all": "eastmoney",
+    "stock_zh_index_spot": "sina",
+    "tool_trade_date_hist_sina": "sina",
+    "bond_new_composite_index_cbond": "chinabond",
+    "bond_cb_index_jsl": "jisilu",
+}
+
+
+class UpstreamUnavailable(Exception):
+    """The call was not made: the source's breaker is open or its rate limit is exhausted."""
+
+
+def source_of(func: Union[Callable, str]) -> str:
+    """Source of an upstream function, or of an akshare function given by name."""
+    name = func if isinstance(func, str) else getattr(func, "__name__", "")
+    if name in sources:
+        return sources[name]
+    if name.endswith("_em"):
+        return "eastmoney"
+    return "other"
+
+
+def get_rates() -> Dict[str, int]:
+    rates = dict(default_rates)
+    rates.update(getattr(settings, "FUND_UPSTREAM_RATES", {}))
+    return rates
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+
+
+_inflight: Dict[str, _Call] = {}
+_inflight_lock = threading.Lock()
+
+
+def call_key(func: Callable, args, kwargs) -> str:
+    name = f"{getattr(func, '__module__', '')}.{getattr(func, '__qualname__', repr(func))}"
+    digest = hashlib.md5(f"{args}-{sorted(kwargs.items())}".encode("utf-8")).hexdigest()
+    return f"{name}-{digest}"
+
+
+def count(name: str, n: int = 1):
+    key = f"upstream-stat-{name}"
+    try:
+        cache.add(key, 0, None)
+        cache.incr(key, n)
+    except Exception as e:
+        logger.debug(f"upstream stat {name} error: {e}")
+
+
+def get_upstream_stats() -> Dict[str, Any]:
+    names = ["calls", "local", "shared"]
+    rates = get_rates()
+    for source in rates:
+        names += [f"rejected-{source}", f"failed-{source}"]
+    found = cache.get_many([f"upstream-stat-{name}" for name in names])
+    stats = {name: found.get(f"upstream-stat-{name}", 0) for name in names}
+    return {
+        "coalescing": {name: stats[name] for name in ["calls", "local", "shared"]},
+        "sources": {
+            source: {
+                "state": breaker_state(source),
+                "rate": rate,
+                "recent_failures": cache.get(f"breaker-failures-{source}", default=0),
+                "failed": stats[f"failed-{source}"],
+                "rejected": stats[f"rejected-{source}"],
+            } for source, rate in rates.items()
+        },
+    }
+
+
+def breaker_state(source: str) -> str:
+    if cache.get(f"breaker-open-{source}", default=None) is not None:
+        return "open"
+    if cache.get(f"breaker-tripped-{source}", default=None) is not None:
+        return "half-open"
+    return "closed"
+
+
+def reject(source: str, reason: str):
+    count(f"rejected-{source}")
+    raise UpstreamUnavailable(f"{source} {reason}")
+
+
+def before_call(source: str):
+    """Fail fast while the source's breaker is open, let a single probe through once it cools down."""
+    state = breaker_state(source)
+    if state == "open":
+        reject(source, "circuit open")
+    if state == "half-open" and not cache.add(f"breaker-probe-{source}", 1, breaker_cooldown):
+        reject(source, "circuit half-open, probe in flight")
+
+
+def acquire(source: str):
+    """Take one token of the source's per-second budget, waiting for the next second when it is spent."""
+    rate = get_rates().get(source, default_rates["other"])
+    deadline = time.time() + rate_wait
+    while True:
+        now = time.time()
+        key = f"ratelimit-{source}-{int(now)}"
+        cache.add(key, 0, 2)
+        try:
+            used = cache.incr(key)
+        except ValueError:
+            # the window expired between add and incr
+            continue
+        if used <= rate:
+            return
+        if int(now) + 1 > deadline:
+            reject(source, "rate limited")
+        time.sleep(int(now) + 1 - now)
+
+
+def record_success(source: str):
+    if cache.get(f"breaker-tripped-{source}", default=None) is not None:
+        logger.info(f"upstream {source} recovered, closing circuit")
+        cache.delete_many([f"breaker-tripped-{source}", f"breaker-probe-{source}", f"breaker-failures-{source}"])
+
+
+def record_failure(source: str, e: BaseException):
+    count(f"failed-{source}")
+    cache.add(f"breaker-failures-{source}", 0, breaker_window)
+    try:
+        failures = cache.incr(f"breaker-failures-{source}")
+    except ValueError:
+        failures = 1
+    probing = cache.get(f"breaker-tripped-{source}", default=None) is not None
+    if probing or failures >= breaker_threshold:
+        logger.warning(f"upstream {source} unhealthy after {failures} failures ({e}), opening circuit for {breaker_cooldown}s")
+        cache.set(f"breaker-open-{source}", time.time(), breaker_cooldown)
+        cache.set(f"breaker-tripped-{source}", True, None)
+        cache.delete(f"breaker-probe-{source}")
+
+
+def guarded(source: str, func: Callable, args, kwargs) -> Any:
+    before_call(source)
+    acquire(source)
+    try:
+        result = func(*args, **kwargs)
+    except failure_errors as e:
+        record_failure(source, e)
+        raise
+    except BaseException:
+        # a bad answer to a probe does not close the circuit, let the next probe decide
+        cache.delete(f"breaker-probe-{source}")
+        raise
+    record_success(source)
+    return result
+
+
+def call(func: Callable, *args, result_ttl: int = 10, source: Optional[str] = None, **kwargs) -> Any:
+    """
+    Call an upstream function, sharing one fetch between identical concurrent calls:
+    threads of this worker wait on the first caller, other workers on a cache lock and
+    pick the result up from the cache, where it stays for result_ttl seconds.
+    Calls are rate limited per source and raise UpstreamUnavailable while the source's breaker is open.
+    """
+    source = source or source_of(func)
+    key = call_key(func, args, kwargs)
+    with _inflight_lock:
+        c = _inflight.get(key, None)
+        leader = c is None
+        if leader:
+            c = _Call()
+            _inflight[key] = c
+
+    if not leader:
+        c.event.wait()
+        count("local")
+        if c.error is not None:
+            raise c.error
+        return c.result
+
+    try:
+        c.result = shared_call(key, source, func, args, kwargs, result_ttl)
+    except BaseException as e:
+        c.error = e
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+        c.event.set()
+    return c.result
+
+
+def shared_call(key: str, source: str, func: Callable, args, kwargs, result_ttl: int) -> Any:
+    result_key = f"upstream-result-{key}"
+    lock_key = f"upstream-lock-{key}"
+
+    result = cache.get(result_key, default=None)
+    if result is not None:
+        count("shared")
+        return result
+
+    if breaker_state(source) == "open":
+        reject(source, "circuit open")
+    if cache.add(lock_key, 1, lock_timeout):
+        try:
+            count("calls")
+            result = guarded(source, func, args, kwargs)
+            if result is not None:
+                cache.set(result_key, result, result_ttl)
+            return result
+        finally:
+            cache.delete(lock_key)
+
+    # another worker is fetching the same thing, wait for its result
+    deadline = time.monotonic() + lock_timeout
+    while time.monotonic() < deadline:
+        time.sleep(poll_interval)
+        result = cache.get(result_key, default=None)
+        if result is not None:
+            count("shared")
+            return result
+        if cache.get(lock_key, default=None) is None:
+            break
+    count("calls")
+    return guarded(source, func, args, kwargs)
+
+
+def get_text(url: str, headers: Optional[Dict[str, str]] = None) -> str:
+    # a hung page would hold the shared fetch lock and never count as a failure
+    resp = requests.get(url, headers=headers, timeout=getattr(settings, "FUND_UPSTREAM_TIMEOUT", 10))
+    resp.raise_for_status()
+    return resp.text
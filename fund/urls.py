@@ -1,5 +1,5 @@
 from django.urls import path
-from .views import index, fund_view, fund_rt_price, watch_add, watch_del
+from .views import index, fund_view, fund_rt_price, fund_rt_series, fund_compare, fund_details, fund_search, stock_holders, upstream_status, portfolio_view, watch_add, watch_del
 
 urlpatterns = [
     path('', index, name='index'),
@@ -7,6 +7,14 @@ urlpatterns = [
     path('fund/<code>', fund_view, name='fund_view_2'),
     path('rt', fund_rt_price, name='fund_rt_view'),
     path('rt/<code>', fund_rt_price, name='fund_rt_view_2'),
+    path('series/<code>', fund_rt_series, name='fund_rt_series'),
+    path('compare', fund_compare, name='fund_compare'),
+    path('funds', fund_details, name='fund_details'),
+    path('search', fund_search, name='fund_search'),
+    path('holders', stock_holders, name='stock_holders'),
+    path('holders/<code>', stock_holders, name='stock_holders_2'),
+    path('upstream', upstream_status, name='upstream_status'),
+    path('portfolio', portfolio_view, name='portfolio_view'),
     path('watch/add/<code>', watch_add, name='watch_add'),
     path('watch/del/<code>', watch_del, name='watch_del'),
 ]
@@ -1,13 +1,28 @@
-from typing import List, Optional, Union
+from typing import List, Optional, Tuple, Union
 from django.http import HttpRequest, JsonResponse
-from django.shortcuts import redirect, render
+from django.shortcuts import render
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
 from django.contrib.auth.decorators import login_required
-from .models import WatchFund
-from user.models import Token
-from .api import Fund, get_fund, get_price, get_rt_price, get_index
+from django.db import transaction
+from django.views.decorators.http import condition
+from django.utils.cache import add_never_cache_headers, patch_cache_control, patch_vary_headers
+from .models import FundHolding, WatchFund
+from .series import get_series
+from .portfolio import get_portfolio
+from .search import search_funds
+from .compare import compare_funds
+from .detail import detail_fields, get_fund_details
+from .upstream import get_upstream_stats
+from user.views import token_or_login_required
+from .api import get_fund_cache, get_fundprice_cache, get_rt_price, get_rt_estimates, get_index, get_rt_version, get_rt_max_age, get_benchmark_rate, rt_price_timeout
 from django.core.cache import cache
 from django.contrib.auth.models import AbstractBaseUser, AnonymousUser
+import datetime
+import functools
+import hashlib
 import logging
+import math
 # Create your views here.
 logger = logging.getLogger("root")
 
@@ -17,13 +32,75 @@ def index(request: HttpRequest):
     user = request.user
     username = user.username
 
-    watch_funds = WatchFund.objects.filter(username=username)
+    index_panel, fund_rows = get_watch_info(username)
+    return render(request, 'home.html', {'fund_rows': fund_rows, 'index_panel': index_panel})
 
-    index_now, china_index, fund_info = get_watch_info(watch_funds)
-    return render(request, 'home.html', {'fund_info': fund_info, 'index': china_index, 'index_now': index_now})
+
+def make_etag(*parts) -> str:
+    return hashlib.md5("|".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+
+
+def fund_rt_etag(request: HttpRequest, code: str = None) -> Optional[str]:
+    """ETag of the estimate for a fund, None when it is not fully cached yet."""
+    if code is None:
+        code = request.GET.get('code', None)
+    if code is None:
+        return None
+    rt_now = get_rt_version()
+    found = cache.get_many([f"fund-{code}", f"residual-{code}"])
+    fund = found.get(f"fund-{code}", None)
+    if rt_now is None or fund is None:
+        return None
+    # the residual and the benchmark proxy change the estimate between factor refreshes
+    return make_etag(code, rt_now, fund.stock_season, fund.bond_season, fund.scale,
+                     found.get(f"residual-{code}", 0), get_benchmark_rate())
+
+
+def fund_view_etag(request: HttpRequest, code: str = None) -> Optional[str]:
+    if request.method != 'GET' and request.method != 'HEAD':
+        return None
+    if code is None:
+        code = request.GET.get('code', None)
+    rt_etag = fund_rt_etag(request, code)
+    fundprice = cache.get(f"fundprice-{code}", default=None)
+    if rt_etag is None or fundprice is None:
+        return None
+    in_favour = any(fundcode == code for fundcode, _ in get_watch_list(request.user.username))
+    return make_etag(rt_etag, fundprice.last_day, fundprice.unit_price, in_favour)
+
+
+def revalidated(etag_func, vary: Optional[List[str]] = None, **cache_control):
+    """
+    condition() whose 304 answers keep the caching headers of the full response, valid until
+    the next factor refresh unless max_age is given; a response that set its own Cache-Control,
+    such as an error, is left alone.
+    """
+    def decorator(view):
+        conditional = condition(etag_func=etag_func)(view)
+
+        @functools.wraps(view)
+        def inner(request: HttpRequest, *args, **kwargs):
+            response = conditional(request, *args, **kwargs)
+            if response.status_code in (200, 304) and not response.has_header('Cache-Control'):
+                if 'max_age' not in cache_control:
+                    patch_cache_control(response, max_age=get_rt_max_age())
+                patch_cache_control(response, **cache_control)
+                if vary:
+                    patch_vary_headers(response, vary)
+            return response
+        return inner
+    return decorator
+
+
+def uncached(response):
+    """An error answer is not kept, the next request tries again."""
+    add_never_cache_headers(response)
+    return response
 
 
 @login_required(login_url='/user/login')
+# the page shows the user's watch state and the latest NAV, the browser revalidates it on every load
+@revalidated(fund_view_etag, private=True, no_cache=True, max_age=0)
 def fund_view(request: HttpRequest, code: str = None):
 
     user = request.user
@@ -35,97 +112,215 @@ def fund_view(request: HttpRequest, code: str = None):
         elif request.method == 'POST':
             code = request.POST.get('code', None)
     if code is None:
-        return render(request, 'fund_info.html', {'alert': {'type': 'danger', 'content': '请输入基金代码'}})
+        return uncached(render(request, 'fund_info.html', {'alert': {'type': 'danger', 'content': '请输入基金代码'}}))
 
     fund = get_fund_cache(code)
     if fund is None:
-        return render(request, 'fund_info.html', {'alert': {'type': 'danger', 'content': f'基金代码 {code} 未找到'}})
+        return uncached(render(request, 'fund_info.html', {'alert': {'type': 'danger', 'content': f'基金代码 {code} 未找到'}}))
 
-    watch_funds = WatchFund.objects.filter(username=username)
     in_favour = 1
-    for wf in watch_funds:
-        if wf.fundcode == code:
+    for fundcode, _ in get_watch_list(username):
+        if fundcode == code:
             in_favour = 2
             break
 
     fundprice = get_fundprice_cache(code)
     if fundprice is None:
-        return render(request, 'fund_info.html', {'alert': {'type': 'danger', 'content': f'基金价格 {code} 查询失败'}, 'fund': fund, 'favour': in_favour})
+        return uncached(render(request, 'fund_info.html', {'alert': {'type': 'danger', 'content': f'基金价格 {code} 查询失败'}, 'fund': fund, 'favour': in_favour}))
 
     try:
-        now, fundrt = get_rt_price(fund)
+        now, estimates = get_rt_estimates([fund])
+        estimate = estimates[fund.code]
         now = now.strftime("%H:%M")
     except Exception as e:
         logger.error(f"Error getting fund evaluated price {code}: {e}")
-        return render(request, 'fund_info.html', {'alert': {'type': 'danger', 'content': '基金估值计算失败'}, 'fund': fund, 'fundprice': fundprice, 'favour': in_favour})
-    logger.info(f"evaluate for {code}: {fundrt}")
-    fund_rt_show = round(fundrt*100, 2)
-    return render(request, 'fund_info.html', {'fund': fund, 'fundprice': fundprice, 'fundrt': fund_rt_show, 'fundrt_now': now, 'favour': in_favour})
+        return uncached(render(request, 'fund_info.html', {'alert': {'type': 'danger', 'content': '基金估值计算失败'}, 'fund': fund, 'fundprice': fundprice, 'favour': in_favour}))
+    logger.info(f"evaluate for {code}: {estimate}")
+    fund_rt_show = round(estimate.rate*100, 2)
+    return render(request, 'fund_info.html', {'fund': fund, 'fundprice': fundprice, 'fundrt': fund_rt_show, 'fundrt_now': now, 'estimate': estimate, 'favour': in_favour, 'holdings_diff': get_holdings_diff(fund)})
 
 
+@token_or_login_required
+# the estimate is the same for every client, a reverse proxy may keep it until the factors refresh
+@revalidated(fund_rt_etag, vary=['Authorization'], public=True)
 def fund_rt_price(request: HttpRequest, code: str = None):
-    user: Union[AbstractBaseUser, AnonymousUser] = request.user
-
-    if not user.is_authenticated:
-        auth_header = request.headers.get('Authorization', None)
-        if auth_header is None:
-            return redirect('/user/login')
-        try:
-            token = auth_header.split()[1]
-            tl = Token.objects.filter(token=token)
-            if len(tl) == 0:
-                return JsonResponse({'status': 'error', 'msg': 'wrong token'}, status=401)
-        except Exception as e:
-            logger.error(f"Error getting token: {e}")
-            return JsonResponse({'status': 'error', 'msg': 'wrong token'}, status=401)
-
     if code is None:
         if request.method == 'GET':
             code = request.GET.get('code', None)
         elif request.method == 'POST':
             code = request.POST.get('code', None)
     if code is None:
-        return JsonResponse({'status': 'error', 'msg': 'error fund code'})
+        return uncached(JsonResponse({'status': 'error', 'msg': 'error fund code'}))
 
     fund = get_fund_cache(code)
     if fund is None:
-        return JsonResponse({'status': 'error', 'msg': 'error getting fund info'})
+        return uncached(JsonResponse({'status': 'error', 'msg': 'error getting fund info'}))
 
     try:
-        now, fundrt = get_rt_price(fund)
+        now, estimates = get_rt_estimates([fund])
+        estimate = estimates[fund.code]
     except Exception as e:
         logger.error(f"Error getting fund {code}: {e}")
-        return JsonResponse({'status': 'error', 'msg': 'error getting fund rt price'})
-    return JsonResponse({'status': 'ok', 'price': fundrt, 'time': now.strftime("%Y-%m-%d %H:%M:%S")})
+        return uncached(JsonResponse({'status': 'error', 'msg': 'error getting fund rt price'}))
+    return JsonResponse({'status': 'ok', 'price': estimate.rate, 'coverage': estimate.coverage, 'proxy_share': estimate.proxy_share, 'time': now.strftime("%Y-%m-%d %H:%M:%S")})
+
+
+@token_or_login_required
+def fund_rt_series(request: HttpRequest, code: str = None):
+    day = request.GET.get('day', None)
+    try:
+        day = datetime.date.fromisoformat(day) if day else None
+    except ValueError:
+        return JsonResponse({'status': 'error', 'msg': 'error day'})
+
+    series = get_series(code, day)
+    if series is None:
+        return JsonResponse({'status': 'error', 'msg': 'no estimates recorded'})
+    times, prices = series
+    return JsonResponse({
+        'status': 'ok',
+        'time': [str(t) for t in times.astype("datetime64[s]").astype(datetime.datetime)],
+        'price': prices.tolist(),
+    })
+
+
+@token_or_login_required
+def fund_search(request: HttpRequest):
+    q = request.GET.get('q', '')
+    try:
+        limit = min(int(request.GET.get('limit', 10)), 50)
+    except ValueError:
+        limit = 10
+    return JsonResponse({'status': 'ok', 'funds': search_funds(q, limit)})
+
+
+@token_or_login_required
+def upstream_status(request: HttpRequest):
+    return JsonResponse({'status': 'ok', **get_upstream_stats()})
+
+
+@token_or_login_required
+def fund_compare(request: HttpRequest):
+    codes = [c for c in request.GET.get('codes', '').split(',') if c]
+    if len(codes) == 0 or len(codes) > 100:
+        return JsonResponse({'status': 'error', 'msg': 'error fund codes'}, status=400)
+    try:
+        start = request.GET.get('start', None)
+        start = datetime.date.fromisoformat(start) if start else None
+        window = int(request.GET.get('window', 252))
+    except ValueError:
+        return JsonResponse({'status': 'error', 'msg': 'error parameters'}, status=400)
+    if window < 1:
+        return JsonResponse({'status': 'error', 'msg': 'window must be at least 1'}, status=400)
+
+    try:
+        result = compare_funds(codes, start, window)
+    except Exception as e:
+        logger.error(f"Error comparing funds {codes}: {e}")
+        return JsonResponse({'status': 'error', 'msg': 'error comparing funds'})
+    return JsonResponse({'status': 'ok', **result})
+
+
+@token_or_login_required
+def fund_details(request: HttpRequest):
+    codes = list(dict.fromkeys(c for c in request.GET.get('codes', '').split(',') if c))
+    if len(codes) == 0 or len(codes) > 1000:
+        return JsonResponse({'status': 'error', 'msg': 'error fund codes'})
+    fields = [f for f in request.GET.get('fields', '').split(',') if f] or detail_fields
+    if any(f not in detail_fields for f in fields):
+        return JsonResponse({'status': 'error', 'msg': f'fields must be among {",".join(detail_fields)}'})
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+        page_size = min(max(int(request.GET.get('page_size', 50)), 1), 100)
+    except ValueError:
+        return JsonResponse({'status': 'error', 'msg': 'error parameters'})
+
+    pages = (len(codes) + page_size - 1) // page_size
+    details, missing = get_fund_details(codes[(page - 1) * page_size:page * page_size], fields)
+    return JsonResponse({
+        'status': 'ok',
+        'page': page,
+        'pages': pages,
+        'total': len(codes),
+        'funds': details,
+        'missing': missing,
+    })
+
+
+@token_or_login_required
+def stock_holders(request: HttpRequest, code: str = None):
+    if code is None:
+        code = request.GET.get('code', None)
+    if code is None:
+        return JsonResponse({'status': 'error', 'msg': 'error stock code'})
+
+    holders = FundHolding.objects.filter(stockcode=code, latest=True).order_by('-share').values_list('fundcode', 'fundname', 'share', 'season')
+    return JsonResponse({
+        'status': 'ok',
+        'funds': [{'code': c, 'name': n, 'share': share, 'season': season} for c, n, share, season in holders],
+    })
+
+
+# larger amounts are typos, and sums of them overflow
+max_position = 1e12
+
+
+@login_required(login_url='/user/login')
+def portfolio_view(request: HttpRequest):
+    user = request.user
+    username = user.username
+
+    alert = None
+    if request.method == 'POST':
+        try:
+            # a bad row leaves every position as it was
+            with transaction.atomic():
+                for wf in WatchFund.objects.filter(username=username):
+                    value = request.POST.get(f"position-{wf.fundcode}", None)
+                    if value is None:
+                        continue
+                    position = float(value or 0)
+                    if not math.isfinite(position) or position < 0 or position > max_position:
+                        raise ValueError(f"invalid position {value}")
+                    if position != wf.position:
+                        wf.position = position
+                        wf.save(update_fields=["position"])
+            alert = {'type': 'success', 'content': '持仓保存成功'}
+        except Exception as e:
+            logger.error(f"Error saving positions of {username}: {e}")
+            alert = {'type': 'danger', 'content': '持仓保存失败'}
+
+    watch_funds = WatchFund.objects.filter(username=username).values_list("fundcode", "fundname", "position")
+    portfolio = get_portfolio(list(watch_funds))
+    return render(request, 'portfolio.html', {'portfolio': portfolio, 'alert': alert})
 
 
 @login_required(login_url='/user/login')
 def watch_add(request: HttpRequest, code: str = None):
     user = request.user
     username = user.username
-    watch_funds = WatchFund.objects.filter(username=username)
+    watch_funds = get_watch_list(username)
 
     if code is None:
-        index_now, china_index, fund_info = get_watch_info(watch_funds)
-        return render(request, 'home.html', {'fund_info': fund_info, 'index': china_index, 'index_now': index_now, 'alert': {'type': 'danger', 'content': '基金代码错误'}})
+        index_panel, fund_rows = get_watch_info(username)
+        return render(request, 'home.html', {'fund_rows': fund_rows, 'index_panel': index_panel, 'alert': {'type': 'danger', 'content': '基金代码错误'}})
 
-    for wf in watch_funds:
-        if wf.fundcode == code:
-            index_now, china_index, fund_info = get_watch_info(watch_funds)
-            return render(request, 'home.html', {'fund_info': fund_info, 'index': china_index, 'index_now': index_now, 'alert': {'type': 'warning', 'content': '基金已经存在'}})
+    for fundcode, _ in watch_funds:
+        if fundcode == code:
+            index_panel, fund_rows = get_watch_info(username)
+            return render(request, 'home.html', {'fund_rows': fund_rows, 'index_panel': index_panel, 'alert': {'type': 'warning', 'content': '基金已经存在'}})
 
     fund = get_fund_cache(code)
     if fund is None:
-        index_now, china_index, fund_info = get_watch_info(watch_funds)
-        return render(request, 'home.html', {'fund_info': fund_info, 'index': china_index, 'index_now': index_now, 'alert': {'type': 'danger', 'content': '获取基金信息失败'}})
+        index_panel, fund_rows = get_watch_info(username)
+        return render(request, 'home.html', {'fund_rows': fund_rows, 'index_panel': index_panel, 'alert': {'type': 'danger', 'content': '获取基金信息失败'}})
 
     nwf = WatchFund(username=username, fundcode=code, fundname=fund.name)
     nwf.save()
+    cache.delete(f"watch-{username}")
 
-    watch_funds = WatchFund.objects.filter(username=username)
-    index_now, china_index, fund_info = get_watch_info(watch_funds)
-
-    return render(request, 'home.html', {'fund_info': fund_info, 'index': china_index, 'index_now': index_now, 'alert': {'type': 'success', 'content': '基金添加成功'}})
+    index_panel, fund_rows = get_watch_info(username)
+    return render(request, 'home.html', {'fund_rows': fund_rows, 'index_panel': index_panel, 'alert': {'type': 'success', 'content': '基金添加成功'}})
 
 
 @login_required(login_url='/user/login')
@@ -133,79 +328,104 @@ def watch_del(request: HttpRequest, code: str = None):
     user: Union[AbstractBaseUser, AnonymousUser] = request.user
     username = user.username
     try:
-        watch_funds = WatchFund.objects.get(username=username, fundcode=code).delete()
+        WatchFund.objects.get(username=username, fundcode=code).delete()
         alert = {'type': 'success', 'content': '基金删除成功'}
     except Exception as e:
         logger.error(f"Error deleting watch fund {code}: {e}")
         alert = {'type': 'danger', 'content': '基金删除失败'}
+    cache.delete(f"watch-{username}")
 
-    watch_funds = WatchFund.objects.filter(username=username)
-    index_now, china_index, fund_info = get_watch_info(watch_funds)
-    return render(request, 'home.html', {'fund_info': fund_info, 'index': china_index, 'index_now': index_now, 'alert': alert})
+    index_panel, fund_rows = get_watch_info(username)
+    return render(request, 'home.html', {'fund_rows': fund_rows, 'index_panel': index_panel, 'alert': alert})
 
 
-def get_fund_cache(code: str) -> Optional[Fund]:
-    fund_cache_timeout = 86400 * 15
+def get_watch_list(username: str) -> List[Tuple[str, str]]:
+    """(code, name) of the user's watched funds, dropped on watch_add/watch_del."""
+    watch_cache_timeout = 86400
 
-    key = f"fund-{code}"
-    try:
-        fund = cache.get(key, default=None)
-        if not fund:
-            fund = get_fund(code)
-            if fund:
-                cache.set(key, fund, fund_cache_timeout)
-    except Exception as e:
-        logger.error(f"error getting fund {code}: {e}")
-        return None
-    return fund
+    key = f"watch-{username}"
+    watch_list = cache.get(key, default=None)
+    if watch_list is None:
+        watch_list = list(WatchFund.objects.filter(username=username).values_list("fundcode", "fundname"))
+        cache.set(key, watch_list, watch_cache_timeout)
+    return watch_list
 
 
-def get_fundprice_cache(code: str) -> Optional[Fund]:
-    fund_cache_timeout = 60*60*24
+def get_holdings_diff(fund) -> Optional[dict]:
+    """Holdings change of the fund's latest season, stored once per season."""
+    if fund.stock_season is None:
+        return None
+    key = f"holdingsdiff-{fund.code}-{fund.stock_season}"
+    diff = cache.get(key, default=None)
+    if diff is None:
+        diff = FundHolding.season_diff(fund.code)
+        if diff is None or diff["season"] != fund.stock_season:
+            return None
+        cache.set(key, diff, None)
+    return diff
+
+
+def get_fund_row(code: str, name: str) -> Optional[str]:
+    """Rendered watch table row of a fund, cached per factor version."""
+    version = get_rt_version()
+    key = f"fundrow-{code}-{version}"
+    if version is not None:
+        row = cache.get(key, default=None)
+        if row is not None:
+            return mark_safe(row)
+
+    fund = get_fund_cache(code)
+    result = {'code': code, 'name': name}
 
-    key = f"fundprice-{code}"
+    fundprice = get_fundprice_cache(code)
+    if fundprice is None:
+        result["unit_price"] = "---"
+        result["rate1"] = "---"
+        result["last_day"] = ""
+    else:
+        result["unit_price"] = fundprice.unit_price
+        result["rate1"] = round(fundprice.rate1*100, 2)
+        result["last_day"] = fundprice.last_day.strftime("%m-%d")
 
+    if fund is None:
+        return None
     try:
-        fundprice = cache.get(key, default=None)
-        if not fundprice:
-            fundprice = get_price(code)
-            if fundprice:
-                cache.set(key, fundprice, fund_cache_timeout)
+        now, fundrt = get_rt_price(fund)
+        result["rt_time"] = now.strftime("%H:%M")
+        result["rt_rate"] = round(fundrt*100, 2)
+        version = now
     except Exception as e:
-        logger.error(f"error getting fund price {code}: {e}")
-        return None
-    return fundprice
+        logger.error(f"Error getting fund {code}: {e}")
+        result["rt_time"] = "---"
+        result["rt_rate"] = "---"
+        version = None
+    logger.debug(result)
 
+    row = render_to_string('fund_row.html', {'fund': result})
+    if version is not None:
+        cache.set(f"fundrow-{code}-{version}", row, rt_price_timeout)
+    return mark_safe(row)
 
-def get_watch_info(watch_funds: List[WatchFund]):
+
+def get_index_panel() -> str:
+    """Rendered index panel, cached per index refresh."""
     index_now, china_index = get_index()
-    index_now = index_now.strftime("%Y-%m-%d %H:%M:%S")
-
-    fund_info = []
-    for wf in watch_funds:
-        fund = get_fund_cache(wf.fundcode)
-        result = {'code': wf.fundcode, 'name': wf.fundname}
-
-        fundprice = get_fundprice_cache(wf.fundcode)
-        if fundprice is None:
-            result["unit_price"] = "---"
-            result["rate1"] = "---"
-            result["last_day"] = ""
-        else:
-            result["unit_price"] = fundprice.unit_price
-            result["rate1"] = round(fundprice.rate1*100, 2)
-            result["last_day"] = fundprice.last_day.strftime("%m-%d")
-
-        if fund is None:
+    key = f"indexpanel-{index_now}"
+    panel = cache.get(key, default=None)
+    if panel is None:
+        index_now_show = index_now.strftime("%Y-%m-%d %H:%M:%S") if index_now else "---"
+        panel = render_to_string('index_panel.html', {'index': china_index, 'index_now': index_now_show})
+        cache.set(key, panel, rt_price_timeout)
+    return mark_safe(panel)
+
+
+def get_watch_info(username: str):
+    index_panel = get_index_panel()
+
+    fund_rows = []
+    for code, name in get_watch_list(username):
+        row = get_fund_row(code, name)
+        if row is None:
             continue
-        try:
-            now, fundrt = get_rt_price(fund)
-            result["rt_time"] = now.strftime("%H:%M")
-            result["rt_rate"] = round(fundrt*100, 2)
-        except Exception as e:
-            logger.error(f"Error getting fund {wf.fundcode}: {e}")
-            result["rt_time"] = "---"
-            result["rt_rate"] = "---"
-        logger.debug(result)
-        fund_info.append(result)
-    return index_now, china_index, fund_info
\ No newline at end of file
+        fund_rows.append(row)
+    return index_panel, fund_rows
@@ -97,6 +97,27 @@ CACHES = {
     },
 }
 
+# refresh interval (seconds) of real-time data during trading sessions,
+# outside sessions the data is kept until the next session opens
+FUND_RT_INTERVAL = int(os.getenv("FUND_RT_INTERVAL", "60"))
+# indices shown on the home page
+FUND_INDEX_CODES = os.getenv("FUND_INDEX_CODES", "sh000001,sh000300,sh000016,sz399006").split(",")
+# days of intraday estimates kept
+FUND_SERIES_RETENTION = int(os.getenv("FUND_SERIES_RETENTION", "7"))
+# days of daily stock returns kept for backtests
+FUND_SPOT_RETENTION = int(os.getenv("FUND_SPOT_RETENTION", "400"))
+# upstream calls per second by source shared by all workers, e.g. "eastmoney:10,sina:2"
+FUND_UPSTREAM_RATES = {
+    source: int(rate) for source, rate in
+    (item.split(":") for item in os.getenv("FUND_UPSTREAM_RATES", "eastmoney:10,sina:2").split(",") if item)
+}
+# seconds an upstream page request may take before it fails
+FUND_UPSTREAM_TIMEOUT = float(os.getenv("FUND_UPSTREAM_TIMEOUT", "10"))
+# whole-market tables a worker process loads at once
+FUND_TABLE_LOADS = int(os.getenv("FUND_TABLE_LOADS", "2"))
+# where the refresher publishes the factor tables for workers to map, shared by all containers
+FUND_FACTOR_DIR = os.getenv("FUND_FACTOR_DIR", os.path.join(BASE_DIR, "data", "factors"))
+
 LOGGING = {
     "version": 1,
     "disable_existing_loggers": False,
@@ -2,4 +2,9 @@ from django.contrib import admin
 from .models import Token
 # Register your models here.
 
-admin.site.register(Token)
\ No newline at end of file
+
+class TokenAdmin(admin.ModelAdmin):
+    list_display = ("username", "__str__")
+
+
+admin.site.register(Token, TokenAdmin)
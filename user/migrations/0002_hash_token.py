@@ -0,0 +1,31 @@
+from django.db import migrations, models
+import hashlib
+
+
+def hash_tokens(apps, schema_editor):
+    Token = apps.get_model('user', 'Token')
+    seen = set()
+    for t in Token.objects.all():
+        digest = hashlib.sha256(t.token.encode("utf-8")).hexdigest()
+        if digest in seen:
+            t.delete()
+            continue
+        seen.add(digest)
+        t.token = digest
+        t.save(update_fields=["token"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(hash_tokens, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='token',
+            name='token',
+            field=models.CharField(max_length=64, unique=True),
+        ),
+    ]
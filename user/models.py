@@ -1,11 +1,66 @@
+import hashlib
 from django.db import models
+from django.db.models.signals import post_delete, pre_save
+from django.dispatch import receiver
+from django.core.cache import cache
 
 # Create your models here.
 
+token_cache_timeout = 300
+
+
+def hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
 
 class Token(models.Model):
     username = models.CharField(max_length=150)
-    token = models.CharField(max_length=150)
+    # sha256 hex digest of the token, the raw token is never stored
+    token = models.CharField(max_length=64, unique=True)
+
+    # the digest as loaded from the database, None for a new token
+    _digest = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._digest = instance.token
+        return instance
+
+    def save(self, *args, **kwargs):
+        # a token that is new or was set since loading is raw; raw fixture loads skip save and keep their digests
+        if self.token != self._digest:
+            self.token = hash_token(self.token)
+        super().save(*args, **kwargs)
+        self._digest = self.token
 
     def __str__(self):
-        return self.username + ":" + self.token
\ No newline at end of file
+        return self.username + ":" + self.token[:8]
+
+
+def check_token(token: str):
+    """Return the username owning the raw token, or None."""
+    digest = hash_token(token)
+    key = f"token-{digest}"
+    username = cache.get(key, default=None)
+    if username is not None:
+        return username
+    t = Token.objects.filter(token=digest).only("username").first()
+    if t is None:
+        return None
+    cache.set(key, t.username, token_cache_timeout)
+    return t.username
+
+
+@receiver(pre_save, sender=Token)
+def invalidate_changed_token(sender, instance: Token, **kwargs):
+    if instance.pk is None:
+        return
+    old = Token.objects.filter(pk=instance.pk).values_list("token", flat=True).first()
+    if old and old != instance.token:
+        cache.delete(f"token-{old}")
+
+
+@receiver(post_delete, sender=Token)
+def invalidate_deleted_token(sender, instance: Token, **kwargs):
+    cache.delete(f"token-{instance.token}")
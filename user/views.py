@@ -1,8 +1,10 @@
 from typing import Union
+from functools import wraps
 from django.shortcuts import render, redirect
 from django.contrib.auth.models import AbstractBaseUser, AnonymousUser
 from django.contrib.auth import authenticate, login, logout
-from django.http import HttpRequest
+from django.http import HttpRequest, JsonResponse
+from .models import check_token
 import logging
 
 # Create your views here.
@@ -40,3 +42,26 @@ def user_logout(request: HttpRequest):
     logger.info(f"User {request.user} logged out")
     logout(request)
     return redirect(success_redir)
+
+
+def token_or_login_required(view):
+    """Allow session users, or API clients sending `Authorization: Token <token>`."""
+    @wraps(view)
+    def wrapper(request: HttpRequest, *args, **kwargs):
+        user: Union[AbstractBaseUser, AnonymousUser] = request.user
+        if user.is_authenticated:
+            return view(request, *args, **kwargs)
+
+        auth_header = request.headers.get('Authorization', None)
+        if auth_header is None:
+            return redirect('/user/login')
+        try:
+            token = auth_header.split()[1]
+            username = check_token(token)
+        except Exception as e:
+            logger.error(f"Error getting token: {e}")
+            username = None
+        if username is None:
+            return JsonResponse({'status': 'error', 'msg': 'wrong token'}, status=401)
+        return view(request, *args, **kwargs)
+    return wrapper